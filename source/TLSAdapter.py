@@ -1,25 +1,17 @@
-import requests
-from requests.adapters import HTTPAdapter
-from requests.packages.urllib3.util.ssl_ import create_urllib3_context
+import ssl
 
 # Force ECDHE because Lotro defaults to 1024bit DH
-# and requests aborts the connection for weak keys
+# and the connection is aborted for weak keys
 # Lotro has an RSA certificate
 CIPHERS = (
         'ECDHE-RSA-AES256-GCM-SHA384'
 )
 
 
-class ECDHEAdapter(HTTPAdapter):
+def create_ecdhe_context():
     """
-    A TransportAdapter that specifies ECDHE in Requests.
+    An SSL context that only offers ECDHE key exchange, for use with aiohttp.
     """
-    def init_poolmanager(self, *args, **kwargs):
-        context = create_urllib3_context(ciphers=CIPHERS)
-        kwargs['ssl_context'] = context
-        return super(ECDHEAdapter, self).init_poolmanager(*args, **kwargs)
-
-    def proxy_manager_for(self, *args, **kwargs):
-        context = create_urllib3_context(ciphers=CIPHERS)
-        kwargs['ssl_context'] = context
-        return super(ECDHEAdapter, self).proxy_manager_for(*args, **kwargs)
+    context = ssl.create_default_context()
+    context.set_ciphers(CIPHERS)
+    return context
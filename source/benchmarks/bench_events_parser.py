@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+""" compares the old regex over the whole events page with the incremental EventsScheduleParser
+
+Usage: python benchmarks/bench_events_parser.py [page.html] [--repeat N]
+Without a page the saved fixture is used. Reports time per parse and peak traced memory for both.
+"""
+
+import argparse
+import gettext
+import os
+import re
+import sys
+import time
+import tracemalloc
+
+source = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, source)
+os.chdir(source)
+gettext.NullTranslations().install()
+
+from calendar_cog import EventsScheduleParser  # noqa: E402
+from utils import chunks  # noqa: E402
+
+fixture = os.path.join(source, 'benchmarks', 'fixtures', 'events_page.html')
+chunk_size = 16384
+
+
+def old_parse(page):
+    """ the previous implementation: download everything, strip the tags, then search """
+    text = re.sub('<[^<]+?>', '', page)
+    pattern = ('Here is the current events schedule(.*)End Time:(.*)'
+               'For the most up-to-date listings of player-run events')
+    m = re.search(pattern, text, re.DOTALL)
+    if not m:
+        return None
+    lines = [line for line in m.group(2).splitlines() if line]
+    return list(chunks(lines, 3))
+
+
+def new_parse(page):
+    """ the current implementation, fed the page in download-sized chunks """
+    parser = EventsScheduleParser()
+    for i in range(0, len(page), chunk_size):
+        parser.feed(page[i:i + chunk_size])
+        if parser.done:
+            break
+    return parser.events()
+
+
+def measure(func, page, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        result = func(page)
+    elapsed = (time.perf_counter() - start) / repeat
+    tracemalloc.start()
+    func(page)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return result, elapsed, peak
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('page', nargs='?', default=fixture)
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args()
+
+    with open(args.page, encoding='utf-8') as f:
+        page = f.read()
+    print("Page: {0} ({1} KB)".format(args.page, len(page) // 1024))
+
+    old, old_time, old_peak = measure(old_parse, page, args.repeat)
+    new, new_time, new_peak = measure(new_parse, page, args.repeat)
+    assert old is not None, "schedule not found"
+    assert old == new, "schedules differ"
+    print("{0} events".format(len(new)))
+    print("{0:<8}{1:>12}{2:>14}".format('', 'time (ms)', 'peak (KB)'))
+    print("{0:<8}{1:>12.2f}{2:>14}".format('regex', old_time * 1000, old_peak // 1024))
+    print("{0:<8}{1:>12.2f}{2:>14}".format('parser', new_time * 1000, new_peak // 1024))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+""" compares utils.get_match with FuzzyMatcher.get_match over the raid list
+
+Usage: python benchmarks/bench_fuzzy_match.py [--repeat N] [--seed S]
+The queries are the full raid names, their nicknames and typo'd variants of both. Both matchers must agree on
+every query.
+"""
+
+import argparse
+import csv
+import os
+import random
+import string
+import sys
+import time
+
+source = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, source)
+os.chdir(source)
+
+from utils import FuzzyMatcher, get_match  # noqa: E402
+
+
+def typo(rng, word):
+    """ delete, swap, replace or insert a character """
+    if len(word) < 2:
+        return word + rng.choice(string.ascii_lowercase)
+    i = rng.randrange(len(word) - 1)
+    kind = rng.randrange(4)
+    if kind == 0:
+        return word[:i] + word[i + 1:]
+    if kind == 1:
+        return word[:i] + word[i + 1] + word[i] + word[i + 2:]
+    if kind == 2:
+        return word[:i] + rng.choice(string.ascii_lowercase) + word[i + 1:]
+    return word[:i] + rng.choice(string.ascii_lowercase) + word[i:]
+
+
+def make_queries(raid_lookup, rng):
+    queries = []
+    for nickname, name in raid_lookup.items():
+        queries.extend([name, nickname, name.lower(), typo(rng, name), typo(rng, typo(rng, name)),
+                        typo(rng, nickname), name.split(':')[-1].strip()])
+    queries.extend(['xyz', 'raid', 'the', 'Anvil', 'tuesday 8pm'])
+    return queries
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    with open('list-of-raids.csv', 'r') as f:
+        raid_lookup = dict(csv.reader(f))
+    word_list = list(raid_lookup.values())
+    queries = make_queries(raid_lookup, random.Random(args.seed))
+    print("{0} raids, {1} queries".format(len(word_list), len(queries)))
+
+    start = time.perf_counter()
+    matcher = FuzzyMatcher(word_list)
+    setup = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for _ in range(args.repeat):
+        old = [get_match(query, word_list) for query in queries]
+    old_time = (time.perf_counter() - start) / args.repeat / len(queries)
+
+    start = time.perf_counter()
+    for _ in range(args.repeat):
+        new = [matcher.get_match(query) for query in queries]
+    new_time = (time.perf_counter() - start) / args.repeat / len(queries)
+
+    mismatches = [(query, a, b) for query, a, b in zip(queries, old, new) if a != b]
+    for mismatch in mismatches:
+        print("Mismatch for {0!r}: get_match {1}, FuzzyMatcher {2}".format(*mismatch))
+    print("get_match      {0:8.1f} us/query".format(old_time * 1e6))
+    print("FuzzyMatcher   {0:8.1f} us/query (setup {1:.1f} ms)".format(new_time * 1e6, setup * 1000))
+    if mismatches:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
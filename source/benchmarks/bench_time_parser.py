@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+""" times time argument parsing with dateparser only, with the fast path and with the memo in front
+
+Usage: python benchmarks/bench_time_parser.py [--repeat N] [--check N] [--seed S]
+--check N additionally compares the fast path with dateparser on N random relative bases and time zones and exits
+with an error if any timestamp differs.
+"""
+
+import argparse
+import datetime
+import os
+import random
+import sys
+import time
+
+source = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, source)
+os.chdir(source)
+
+import pytz  # noqa: E402
+
+import time_parser  # noqa: E402
+from utils import LRUCache  # noqa: E402
+
+# Time arguments as users type them in raid commands.
+corpus = ['8pm', 'friday 8pm', 'fri 8pm', '8pm friday', 'saturday 20:00', 'sat 9pm', 'sunday 7:30pm', '21:00',
+          '8:30 pm', 'tuesday 8 pm', '26 july 8pm', 'july 26 20:00', 'jul 26 8pm', '1 jan 12pm', 'dec 31 11pm',
+          'wednesday', 'thursday 19:30', 'monday 6pm', '7pm', '20:30', 'now', 'in 2 hours', 'in 30 minutes',
+          'tomorrow 8pm', 'next friday 8pm', 'friday 8pm cet', '8pm est', '2026-11-01 20:00', 'sept 5 8pm',
+          'tues 8pm']
+zones = ['UTC', 'Europe/Berlin', 'Europe/London', 'America/New_York', 'America/Los_Angeles', 'America/St_Johns',
+         'Australia/Sydney', 'Pacific/Auckland', 'Asia/Kolkata']
+
+
+def run(arguments, tz_name, now, parser):
+    for argument in arguments:
+        time_parser.parse(argument, tz_name, False, now, None, parser)
+
+
+def run_memo(arguments, tz_name, now, parser, memo):
+    """ the converter's lookup: key on the normalised argument and the minute of the relative base """
+    for argument in arguments:
+        key = (' '.join(argument.lower().split()), tz_name, False, int(now.timestamp()) // 60)
+        if memo.get(key) is None:
+            result = time_parser.parse(argument, tz_name, False, now, None, parser)
+            if result is not None and not (result.second or result.microsecond):
+                memo.put(key, int(result.timestamp()))
+
+
+def without_fast_path(func, *args):
+    fast_parse = time_parser.fast_parse
+    time_parser.fast_parse = lambda *a: None
+    try:
+        return func(*args)
+    finally:
+        time_parser.fast_parse = fast_parse
+
+
+def measure(repeat, func, *args):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        func(*args)
+    return (time.perf_counter() - start) / repeat / len(corpus)
+
+
+def check(count, rng):
+    """ compare the fast path with dateparser alone on random bases, returns the number of mismatches """
+    mismatches = checked = 0
+    for n in range(count):
+        now = datetime.datetime(2026, 1, 1, tzinfo=datetime.timezone.utc) + datetime.timedelta(
+            seconds=rng.randint(0, 366 * 86400), microseconds=rng.randint(1, 999999))
+        tz_name = rng.choice(zones)
+        tz = pytz.timezone(tz_name)
+        for argument in corpus:
+            if time_parser.fast_parse(argument, now.astimezone(tz).replace(tzinfo=None), tz) is None:
+                continue
+            checked += 1
+            fast = time_parser.parse(argument, tz_name, False, now)
+            slow = without_fast_path(time_parser.parse, argument, tz_name, False, now)
+            if (fast and fast.timestamp()) != (slow and slow.timestamp()):
+                mismatches += 1
+                print("Mismatch for {0!r} in {1} at {2}: {3} != {4}".format(argument, tz_name, now, fast, slow))
+    print("Checked {0} fast path results, {1} mismatches".format(checked, mismatches))
+    return mismatches
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--check', type=int, default=0)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    date_parser = time_parser.warm_up(None, zones)
+    now = datetime.datetime.now(tz=datetime.timezone.utc).replace(second=30)
+    fast = sum(time_parser.fast_parse(argument, now.replace(tzinfo=None), pytz.utc) is not None
+               for argument in corpus)
+    print("{0} arguments, {1} on the fast path".format(len(corpus), fast))
+
+    tz_name = 'Europe/Berlin'
+    slow_time = without_fast_path(measure, args.repeat, run, corpus, tz_name, now, date_parser)
+    fast_time = measure(args.repeat, run, corpus, tz_name, now, date_parser)
+    memo = LRUCache(1024)
+    memo_time = measure(args.repeat, run_memo, corpus, tz_name, now, date_parser, memo)
+    print("dateparser   {0:8.1f} us/argument".format(slow_time * 1e6))
+    print("fast path    {0:8.1f} us/argument".format(fast_time * 1e6))
+    print("memo         {0:8.1f} us/argument ({1} hits, {2} misses)".format(memo_time * 1e6, memo.hits,
+                                                                               memo.misses))
+
+    if args.check and check(args.check, random.Random(args.seed)):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
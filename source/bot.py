@@ -9,14 +9,16 @@ import logging
 import os
 import re
 
-from database import create_connection, create_table, increment, select, upsert
+from database import AsyncDatabase, create_connection, migrate
+from embed_layout import RenderCache
+from guild_settings import SettingsCache
+from utils import WorkerPool
 
 
-class Bot(commands.Bot):
+class Bot(commands.AutoShardedBot):
 
     def __init__(self):
         self.launch_time = datetime.utcnow()
-        self.api = "https://discord.com/api/v10/"
 
         version = ""
         with open('__init__.py') as f:
@@ -80,6 +82,7 @@ class Bot(commands.Bot):
         self.twitter_id = read_config_key(config, 'TWITTER_ID', False)
 
         language = read_config_key(config, 'LANGUAGE', False)
+        self.language = language
         if language == 'fr':
             locale.setlocale(locale.LC_TIME, "fr_FR.UTF-8")
         localization = gettext.translation('messages', localedir='locale', languages=[language], fallback=True)
@@ -89,20 +92,78 @@ class Bot(commands.Bot):
             logger.warning("Language file '{0}' not found. Defaulting to English.".format(language))
         localization.install()
 
-        conn = create_connection('raid_db')
+        # Connection profile, each pragma can be overridden with a DB_<PRAGMA> config key.
+        pragma_defaults = {
+            'journal_mode': 'WAL',
+            'synchronous': 'NORMAL',
+            'cache_size': -16000,  # Negative values are in KiB.
+            'mmap_size': 268435456,
+            'temp_store': 'MEMORY',
+            'busy_timeout': 5000
+        }
+        pragmas = {}
+        for pragma, default in pragma_defaults.items():
+            value = read_config_key(config, 'DB_' + pragma.upper(), False)
+            pragmas[pragma] = default if value is None else value
+
+        conn = create_connection('raid_db', pragmas)
         if conn:
             self.logger.info("Bot connected to raid database.")
-            create_table(conn, 'settings')
+            if not migrate(conn):
+                raise SystemExit
         else:
             self.logger.error("main could not create database connection!")
         self.conn = conn
+        self.db = AsyncDatabase(conn)
+        self.settings = SettingsCache(self.db, self.owns_guild)
+        # Fingerprints of rendered raid posts and calendars, kept across restarts if PERSIST_FINGERPRINTS is set.
+        persist_fingerprints = read_config_key(config, 'PERSIST_FINGERPRINTS', False)
+        if str(persist_fingerprints).lower() in ('1', 'true', 'yes'):
+            # On a connection of their own, which commits their batches without touching the raid transactions.
+            self.fingerprints = RenderCache(AsyncDatabase(create_connection('raid_db', pragmas)))
+        else:
+            self.fingerprints = RenderCache()
+
+        # CPU heavy calls (time parsing, fuzzy matching) run on a pool of WORKER_POOL_SIZE threads, or processes if
+        # WORKER_POOL is 'process'. The size defaults to the executor's default.
+        worker_kind = read_config_key(config, 'WORKER_POOL', False) or 'thread'
+        worker_size = read_config_key(config, 'WORKER_POOL_SIZE', False)
+        try:
+            self.workers = WorkerPool(worker_kind, int(worker_size) if worker_size else None)
+        except ValueError as e:
+            logging.critical(e)
+            raise SystemExit
+
+        # Sharding, a single shard by default. SHARD_COUNT can be 'auto' to use Discord's recommendation. SHARD_IDS lists
+        # the shards this process runs, e.g. "0,1", when several processes share the shards.
+        shard_count = read_config_key(config, 'SHARD_COUNT', False)
+        shard_ids = read_config_key(config, 'SHARD_IDS', False)
+        if isinstance(shard_ids, str):
+            shard_ids = [int(shard_id) for shard_id in shard_ids.split(",") if shard_id.strip()]
+        if shard_count is None and shard_ids is None:
+            shard_count = 1
+        elif str(shard_count).lower() == 'auto' and shard_ids is None:
+            shard_count = None
+        else:
+            try:
+                shard_count = int(shard_count)
+            except (TypeError, ValueError):
+                logging.critical("SHARD_COUNT must be a number, or 'auto' when SHARD_IDS is not given.")
+                raise SystemExit
+            if shard_ids is not None and not all(0 <= shard_id < shard_count for shard_id in shard_ids):
+                logging.critical("SHARD_IDS must be between 0 and SHARD_COUNT - 1.")
+                raise SystemExit
 
         intents = discord.Intents.none()
         intents.guilds = True
+        # Message delete events let the raid cog drop deleted raid posts.
+        intents.guild_messages = True
         intents.dm_messages = True
 
         super().__init__(command_prefix=self.prefix_manager, case_insensitive=True, intents=intents,
-                         activity=discord.Game(name=self.version))
+                         activity=discord.Game(name=self.version), shard_count=shard_count, shard_ids=shard_ids)
+        if shard_ids is not None:
+            self.logger.info("Running shards {0} of {1}.".format(shard_ids, shard_count))
 
         async def globally_block_dms(ctx):
             if ctx.guild is None and not await ctx.bot.is_owner(ctx.author):
@@ -112,6 +173,32 @@ class Bot(commands.Bot):
 
         super().add_check(globally_block_dms)
 
+    def owns_guild(self, guild_id):
+        """ whether the guild is on one of the shards run by this process """
+        if self.shard_ids is None:
+            return True
+        return (guild_id >> 22) % self.shard_count in self.shard_ids
+
+    @property
+    def is_primary(self):
+        """ whether this process runs the background work that should happen once for all shards """
+        return self.shard_ids is None or 0 in self.shard_ids
+
+    async def setup_hook(self):
+        await self.settings.load()
+        await self.fingerprints.load()
+
+    async def close(self):
+        await super().close()
+        self.workers.shutdown()
+        await self.fingerprints.close()
+        self.db.close()
+
+    async def on_message(self, message):
+        # The guild_messages intent is only wanted for raw message deletes, commands still come from DMs only.
+        if message.guild is None:
+            await self.process_commands(message)
+
     def prefix_manager(self, bot, message):
         return commands.when_mentioned_or("!")(bot, message)
 
@@ -1,17 +1,21 @@
+import aiohttp
+import asyncio
+import codecs
 import dateparser
 import discord
 import logging
 import pytz
-import re
-import requests
 
 from datetime import datetime, timedelta
 from discord import app_commands
 from discord.ext import commands
+from discord.ext import tasks
+from discord.http import Route
+from html.parser import HTMLParser
 
-from database import select_one, select_order, upsert
-from TLSAdapter import ECDHEAdapter
-from utils import chunks
+from TLSAdapter import create_ecdhe_context
+from embed_layout import fingerprint
+from utils import Coalescer, chunks
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
@@ -23,21 +27,98 @@ class CalendarGroup(app_commands.Group):
         super().__init__(name=_("calendar"), description=_("Manage the calendar settings."))
 
 
+class EventsScheduleParser(HTMLParser):
+    """ incrementally extracts the lines of the events schedule from the forum page
+
+    Feed it the page in chunks; done is set once the end of the schedule has been seen and anything fed afterwards
+    is ignored. Only the tail of the text that could still contain a marker is kept while searching.
+    """
+
+    # Let us hope these questionable markers are stable enough
+    start_marker = 'Here is the current events schedule'
+    header_marker = 'End Time:'
+    end_marker = 'For the most up-to-date listings of player-run events'
+
+    def __init__(self):
+        super().__init__()
+        self.markers = [self.start_marker, self.header_marker, self.end_marker]
+        self.text = ''
+        self.lines = []
+        self.done = False
+
+    def handle_data(self, data):
+        if self.done:
+            return
+        self.text += data
+        while self.markers[:-1]:
+            marker = self.markers[0]
+            index = self.text.find(marker)
+            if index < 0:
+                self.text = self.text[-len(marker) + 1:]
+                return
+            self.text = self.text[index + len(marker):]
+            self.markers.pop(0)
+        index = self.text.find(self.end_marker)
+        if index >= 0:
+            self.add_lines(self.text[:index])
+            self.text = ''
+            self.done = True
+            return
+        # Complete lines cannot contain the end of the schedule, so they are safe to hand over.
+        lines = self.text.splitlines(keepends=True)
+        if lines and lines[-1].splitlines() == [lines[-1]]:
+            self.text = lines.pop()
+        else:
+            self.text = ''
+        self.add_lines(''.join(lines))
+
+    def add_lines(self, text):
+        self.lines.extend(line for line in text.splitlines() if line)
+
+    def events(self):
+        """ return the schedule as [name, start, end] chunks, or None if the schedule was not found """
+        if not self.done:
+            return None
+        return list(chunks(self.lines, 3))
+
+
+async def read_events_schedule(response, chunk_size=16384):
+    """ stream the events page through an EventsScheduleParser, returns its events() """
+    parser = EventsScheduleParser()
+    # get_encoding() cannot guess before the body is read, the forum serves utf-8 when it does not say.
+    decoder = codecs.getincrementaldecoder(response.charset or 'utf-8')(errors='replace')
+    async for chunk in response.content.iter_chunked(chunk_size):
+        parser.feed(decoder.decode(chunk))
+        if parser.done:
+            break
+    return parser.events()
+
+
 class CalendarCog(commands.Cog):
+    events_url = "https://forums.lotro.com/forums/showthread.php?646193-LOTRO-Events-Schedule&s=37ca62f1171274310d6709145d372d3f&p=7646830#post7646830"
+    events_max_age = 86400
+    # After a failed refresh, stale requests wait this long before trying lotro.com again.
+    events_retry_delay = 600
+
     def __init__(self, bot):
         self.bot = bot
-        self.conn = bot.conn
+        self.db = bot.db
         self.time_cog = bot.get_cog('TimeCog')
-        self.upcoming_events = None
+        self.session = None
+        self.upcoming_events = []
         self.cached_events_at = None
-        self.headers = {
-            "Authorization": "Bot {0}".format(bot.token)
-        }
-
-    def is_raid_leader(self, user, guild):
+        self.events_etag = None
+        self.events_last_modified = None
+        self.events_refresh = None
+        self.events_attempted_at = None
+        # Calendar edits for the same guild are batched into at most one per window.
+        self.calendar_updates = Coalescer(self.edit_calendar, 5)
+        self.new_runs = set()
+
+    async def is_raid_leader(self, user, guild):
         if user.guild_permissions.administrator:
             return True
-        raid_leader_id = select_one(self.conn, 'Settings', ['raid_leader'], ['guild_id'], [guild.id])
+        raid_leader_id = self.bot.settings.get(guild.id).raid_leader
         if raid_leader_id:
             raid_leader = guild.get_role(raid_leader_id)
             if raid_leader in user.roles:
@@ -45,15 +126,29 @@ class CalendarCog(commands.Cog):
         return False
 
     async def post_calendar(self, guild_id, channel):
-        embed = self.calendar_embed(guild_id)
+        embed = await self.calendar_embed(guild_id)
         msg = await channel.send(embed=embed)
+        await self.bot.fingerprints.remember(msg.id, self.calendar_fingerprint(embed))
         ids = "{0}/{1}".format(channel.id, msg.id)
-        res = upsert(self.conn, 'Settings', ['calendar'], [ids], ['guild_id'], [guild_id])
-        self.conn.commit()
+        res = await self.bot.settings.update(guild_id, ['calendar'], [ids])
+        await self.db.commit()
 
-    async def update_calendar(self, guild_id, new_run=True):
-        conn = self.bot.conn
-        res = select_one(conn, 'Settings', ['calendar'], ['guild_id'], [guild_id])
+    def update_calendar(self, guild_id, new_run=True):
+        """ mark the guild's calendar for an update, announcing the new run if new_run """
+        if new_run:
+            self.new_runs.add(guild_id)
+        self.calendar_updates.schedule(guild_id)
+
+    @staticmethod
+    def calendar_fingerprint(embed):
+        """ fingerprint of the calendar's visible content, an edit that only updates the timestamp is not worth it """
+        return fingerprint(embed, ignore=('timestamp',))
+
+    async def edit_calendar(self, guild_id):
+        db = self.db
+        new_run = guild_id in self.new_runs
+        self.new_runs.discard(guild_id)
+        res = self.bot.settings.get(guild_id).calendar
         if not res:
             return
         result = res.split("/")
@@ -64,21 +159,25 @@ class CalendarCog(commands.Cog):
             msg = chn.get_partial_message(msg_id)
         except AttributeError:
             logger.warning("Calendar channel not found for guild {0}.".format(guild_id))
-            res = upsert(conn, 'Settings', ['calendar'], [None], ['guild_id'], [guild_id])
+            res = await self.bot.settings.update(guild_id, ['calendar'], [None])
             if res:
-                conn.commit()
+                await db.commit()
             return
 
-        embed = self.calendar_embed(guild_id)
+        embed = await self.calendar_embed(guild_id)
+        digest = self.calendar_fingerprint(embed)
         try:
-            await msg.edit(embed=embed)
+            if not self.bot.fingerprints.unchanged(msg_id, digest):
+                await msg.edit(embed=embed)
+                await self.bot.fingerprints.remember(msg_id, digest)
         except discord.Forbidden:
             logger.warning("Calendar access restricted for guild {0}.".format(guild_id))
             return
         except discord.NotFound:
             logger.warning("Calendar post not found for guild {0}.".format(guild_id))
-            upsert(conn, 'Settings', ['calendar'], [None], ['guild_id'], [guild_id])
-            conn.commit()
+            await self.bot.fingerprints.forget(msg_id)
+            await self.bot.settings.update(guild_id, ['calendar'], [None])
+            await db.commit()
             return
         except discord.HTTPException as e:
             logger.warning("Failed to update calendar for guild {0}.".format(guild_id))
@@ -90,10 +189,14 @@ class CalendarCog(commands.Cog):
             except discord.Forbidden:
                 logger.warning("No write access to calendar channel for guild {0}.".format(guild_id))
 
-    def calendar_embed(self, guild_id):
-        conn = self.bot.conn
-        raids = select_order(conn, 'Raids', ['channel_id', 'raid_id', 'name', 'tier', 'time'], 'time', ['guild_id'],
-                             [guild_id])
+    async def calendar_embed(self, guild_id):
+        raid_cog = self.bot.get_cog('RaidCog')
+        if raid_cog:
+            raids = [(raid.channel_id, raid.raid_id, raid.name, raid.tier, raid.time)
+                     for raid in raid_cog.raids.guild_raids(guild_id)]
+        else:
+            raids = await self.db.select_order('Raids', ['channel_id', 'raid_id', 'name', 'tier', 'time'], 'time',
+                                               ['guild_id'], [guild_id])
 
         title = _("Scheduled runs:")
         desc = _("Click the link to sign up!")
@@ -112,134 +215,211 @@ class CalendarCog(commands.Cog):
         embed.timestamp = datetime.now()
         return embed
 
-    def create_guild_event(self, raid_id):
-        conn = self.bot.conn
-        channel_id, guild_id, name, tier, description, timestamp = select_one(conn, 'Raids', ['channel_id', 'guild_id', 'name', 'tier', 'boss', 'time'], ['raid_id'], [raid_id])
-        res = select_one(conn, 'Settings', ['guild_events'], ['guild_id'], [guild_id])
-        if not res:
+    @staticmethod
+    def event_name(raid):
+        if raid.tier:
+            return " ".join([raid.name, raid.tier])
+        return raid.name
+
+    async def create_guild_event(self, raid):
+        guild_id = raid.guild_id
+        if not self.bot.settings.get(guild_id).guild_events:
             return
 
-        metadata = {"location": f"https://discord.com/channels/{guild_id}/{channel_id}/{raid_id}"}
-        start_time = datetime.utcfromtimestamp(timestamp).isoformat() + 'Z'
-        end_time = datetime.utcfromtimestamp(timestamp+7200).isoformat() + 'Z'
-        if tier:
-            event_name = " ".join([name, tier])
-        else:
-            event_name = name
+        metadata = {"location": f"https://discord.com/channels/{guild_id}/{raid.channel_id}/{raid.raid_id}"}
+        start_time = datetime.utcfromtimestamp(raid.time).isoformat() + 'Z'
+        end_time = datetime.utcfromtimestamp(raid.time+7200).isoformat() + 'Z'
         data = {
             "entity_metadata": metadata,
-            'name': event_name,
+            'name': self.event_name(raid),
             "privacy_level": 2,
             "scheduled_start_time": start_time,
             "scheduled_end_time": end_time,
-            "description": description,
+            "description": raid.boss,
             "entity_type": 3
             }
-        url = self.bot.api + f"guilds/{guild_id}/scheduled-events"
-        r = requests.post(url, headers=self.headers, json=data)
-        r.raise_for_status()
-        event = r.json()
+        # The bot's own http client reuses its connection and handles rate limits and retries.
+        route = Route('POST', '/guilds/{guild_id}/scheduled-events', guild_id=guild_id)
+        event = await self.bot.http.request(route, json=data)
         event_id = event['id']
         return event_id
 
-    def modify_guild_event(self, raid_id):
-        conn = self.bot.conn
-        guild_id, event_id, name, tier, description, timestamp = select_one(conn, 'Raids', ['guild_id', 'event_id', 'name', 'tier', 'boss', 'time'], ['raid_id'], [raid_id])
-        if not event_id:
+    async def modify_guild_event(self, raid):
+        if not raid.event_id:
             return
 
-        start_time = datetime.utcfromtimestamp(timestamp).isoformat() + 'Z'
-        end_time = datetime.utcfromtimestamp(timestamp+7200).isoformat() + 'Z'
+        start_time = datetime.utcfromtimestamp(raid.time).isoformat() + 'Z'
+        end_time = datetime.utcfromtimestamp(raid.time+7200).isoformat() + 'Z'
         data = {
-                'name': " ".join([name, tier]),
-                'description': description,
+                'name': self.event_name(raid),
+                'description': raid.boss,
                 'scheduled_start_time': start_time,
                 'scheduled_end_time': end_time
                 }
-        url = self.bot.api + f"guilds/{guild_id}/scheduled-events/{event_id}"
-        r = requests.patch(url, headers=self.headers, json=data)
-        r.raise_for_status()
+        route = Route('PATCH', '/guilds/{guild_id}/scheduled-events/{event_id}', guild_id=raid.guild_id,
+                      event_id=raid.event_id)
+        await self.bot.http.request(route, json=data)
 
-    def delete_guild_event(self, raid_id):
-        conn = self.bot.conn
-        try:
-            guild_id, event_id = select_one(conn, 'Raids', ['guild_id', 'event_id'], ['raid_id'], [raid_id])
-        except TypeError:
-            logger.info("Raid already deleted from database.")
+    async def delete_guild_event(self, raid):
+        if not raid.event_id:
             return
-        if not event_id:
-            return
-
-        url = self.bot.api + f"guilds/{guild_id}/scheduled-events/{event_id}"
-        r = requests.delete(url, headers=self.headers)
-        r.raise_for_status()
 
-    def get_events(self):
+        route = Route('DELETE', '/guilds/{guild_id}/scheduled-events/{event_id}', guild_id=raid.guild_id,
+                      event_id=raid.event_id)
+        await self.bot.http.request(route)
+
+    async def cog_load(self):
+        await self.load_events()
+        self.session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=30))
+        if self.bot.shard_ids is not None and self.bot.is_primary:
+            self.events_task.start()
+
+    async def cog_unload(self):
+        self.calendar_updates.cancel()
+        self.events_task.cancel()
+        if self.events_refresh and not self.events_refresh.done():
+            self.events_refresh.cancel()
+        await self.session.close()
+
+    async def load_events(self):
+        rows = await self.db.select('Events', ['name', 'start_time', 'end_time'])
+        self.upcoming_events = sorted(rows, key=lambda event: event[1])
+        res = await self.db.select_one('EventsSource', ['etag', 'last_modified', 'fetched_at'], ['url'],
+                                       [self.events_url])
+        if res:
+            self.events_etag, self.events_last_modified, self.cached_events_at = res
+
+    async def get_events(self):
+        """ return the cached events, revalidating them in the background once they are stale """
         current_time = datetime.now().timestamp()
-        if self.cached_events_at and self.cached_events_at + 86400 > current_time:
-            return self.upcoming_events
-
-        s = requests.Session()
-        s.mount("https://forums.lotro.com", ECDHEAdapter())
-        r = s.get("https://forums.lotro.com/forums/showthread.php?646193-LOTRO-Events-Schedule&s=37ca62f1171274310d6709145d372d3f&p=7646830#post7646830")
-        if not r.ok:
-            logger.warning("Could not connect to lotro.com")
-            return self.upcoming_events
-
-        stripped = re.sub('<[^<]+?>', '', r.text)
-        # Let us hope this questionable pattern is stable enough
-        pattern = 'Here is the current events schedule(.*)End Time:(.*)For the most up-to-date listings of player-run events'
-        prog = re.compile(pattern, flags=re.DOTALL)
-        result = prog.search(stripped)
-        data  = [line for line in result.group(2).splitlines() if line]
-        events = [chunk for chunk in chunks(data, 3)]
-        parsed_events = [(event[0], self.parse_event_time(event[1]), self.parse_event_time(event[2])) for event in events]
+        stale = not self.cached_events_at or self.cached_events_at + self.events_max_age < current_time
+        retry = not self.events_attempted_at or self.events_attempted_at + self.events_retry_delay < current_time
+        if stale and retry and not (self.events_refresh and not self.events_refresh.done()):
+            self.events_attempted_at = current_time
+            self.events_refresh = asyncio.create_task(self.refresh_events())
+        if not self.cached_events_at and self.events_refresh:
+            # Nothing to serve yet, so this request has to wait for lotro.com.
+            await asyncio.shield(self.events_refresh)
 
         cutoff_past = current_time - 86400
         cutoff_future = current_time + 90 * 86400
-        upcoming_events = [event for event in parsed_events if cutoff_past < event[2] < cutoff_future]
-        self.cached_events_at = current_time
-        self.upcoming_events = upcoming_events
-        return upcoming_events
+        return [event for event in self.upcoming_events if cutoff_past < event[2] < cutoff_future]
 
-    def events_embed(self, guild_id):
-        events = self.get_events()
+    async def refresh_events(self):
+        """ fetch the events, logging any failure since nobody waits for the background refresh """
+        try:
+            await self.fetch_events()
+        except Exception:
+            logger.exception("Refreshing the events schedule failed.")
+
+    async def fetch_events(self):
+        if not self.bot.is_primary:
+            # Only the primary process fetches the schedule, the others pick up what it stored.
+            await self.load_events()
+            return
+        headers = {}
+        if self.events_etag:
+            headers['If-None-Match'] = self.events_etag
+        if self.events_last_modified:
+            headers['If-Modified-Since'] = self.events_last_modified
+        try:
+            async with self.session.get(self.events_url, headers=headers, ssl=create_ecdhe_context()) as r:
+                if r.status == 304:
+                    logger.info("Events schedule not modified.")
+                    events = None
+                elif r.status == 200:
+                    schedule = await read_events_schedule(r)
+                    if schedule is None:
+                        logger.warning("Events schedule not found on lotro.com")
+                        return
+                    events = await asyncio.get_running_loop().run_in_executor(None, self.parse_events, schedule)
+                else:
+                    logger.warning("Could not connect to lotro.com")
+                    return
+                etag = r.headers.get('ETag')
+                last_modified = r.headers.get('Last-Modified')
+                if r.status == 304:
+                    # A 304 need not repeat the validators, keep the ones we have.
+                    etag = etag or self.events_etag
+                    last_modified = last_modified or self.events_last_modified
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            logger.warning("Could not connect to lotro.com")
+            logger.warning(e)
+            return
+
+        self.cached_events_at = int(datetime.now().timestamp())
+        self.events_etag = etag
+        self.events_last_modified = last_modified
+        if events is not None:
+            self.upcoming_events = events
+            await self.db.replace_all('Events', ['name', 'start_time', 'end_time'], events)
+        await self.db.upsert('EventsSource', ['etag', 'last_modified', 'fetched_at'],
+                             [etag, last_modified, self.cached_events_at], ['url'], [self.events_url])
+        await self.db.commit()
+
+    @tasks.loop(seconds=events_max_age)
+    async def events_task(self):
+        # When sharded the primary process keeps the stored schedule fresh for the others.
+        await self.refresh_events()
+
+    @events_task.before_loop
+    async def before_events_task(self):
+        await self.bot.wait_until_ready()
+
+    @events_task.error
+    async def handle_events_error(self, exception):
+        logger.error("Events task failed.")
+        logger.error(exception, exc_info=True)
+
+    @classmethod
+    def parse_events(cls, schedule):
+        """ convert [name, start, end] chunks to (name, start, end) tuples, runs in an executor """
+        return [(event[0], cls.parse_event_time(event[1]), cls.parse_event_time(event[2])) for event in schedule]
+
+    async def events_embed(self, guild_id):
+        events = await self.get_events()
 
         title = _("Upcoming events:")
         embed = discord.Embed(title=title, colour=discord.Colour(0x3498db))
         for e in events:
             time_str = f"<t:{e[1]}> -- <t:{e[2]}>"
             embed.add_field(name=e[0], value=time_str, inline=False)
-        embed.set_footer(text=_("Last updated"))
-        embed.timestamp = datetime.fromtimestamp(self.cached_events_at)
+        if self.cached_events_at:
+            embed.set_footer(text=_("Last updated"))
+            embed.timestamp = datetime.fromtimestamp(self.cached_events_at)
         return embed
 
-    def parse_event_time(self, time):
-        time = pytz.timezone("America/New_York").localize(dateparser.parse(time)).timestamp()
+    @staticmethod
+    def parse_event_time(time):
+        time = pytz.timezone("America/New_York").localize(dateparser.parse(time, languages=['en'])).timestamp()
         return int(time)
 
     @app_commands.command(name=_("events"), description=_("Shows upcoming official LotRO events in your local time."))
     @app_commands.guild_only()
     async def events_respond(self, interaction: discord.Interaction):
+        if self.cached_events_at:
+            embed = await self.events_embed(interaction.guild_id)
+            await interaction.response.send_message(embed=embed)
+            return
         await interaction.response.send_message(_("Waiting for lotro.com to respond..."))
-        events = self.events_embed(interaction.guild_id)
-        await interaction.edit_original_message(content='', embed=events)
+        embed = await self.events_embed(interaction.guild_id)
+        await interaction.edit_original_message(content='', embed=embed)
 
     group = CalendarGroup()
 
     @group.command(name=_("off"), description=("Turn off calendars."))
     async def calendar_off(self, interaction: discord.Interaction):
-        if not self.is_raid_leader(interaction.user, interaction.guild):
+        if not await self.is_raid_leader(interaction.user, interaction.guild):
             await interaction.response.send_message(_("You must be a raid leader to change the calendar settings."), ephemeral=True)
             return
-        upsert(self.conn, 'Settings', ['calendar', 'guild_events'], [None, False], ['guild_id'], [interaction.guild_id])
+        await self.bot.settings.update(interaction.guild_id, ['calendar', 'guild_events'], [None, False])
+        await self.db.commit()
         content = _("Events will not be posted to a calendar.")
         await interaction.response.send_message(content, ephemeral=True)
-        self.conn.commit()
 
     @group.command(name=_("channel"), description=("Post events to calendar in this channel."))
     async def calendar_channel(self, interaction: discord.Interaction):
-        if not self.is_raid_leader(interaction.user, interaction.guild):
+        if not await self.is_raid_leader(interaction.user, interaction.guild):
             await interaction.response.send_message(_("You must be a raid leader to change the calendar settings."), ephemeral=True)
             return
         channel = interaction.channel
@@ -248,25 +428,25 @@ class CalendarCog(commands.Cog):
         if not (perms.send_messages and perms.embed_links):
             await interaction.response.send_message(_("Missing permissions to access this channel."))
             return
-        upsert(self.conn, 'Settings', ['guild_events'], [False], ['guild_id'], [guild.id])
+        await self.bot.settings.update(guild.id, ['guild_events'], [False])
+        await self.db.commit()
         content = _("Events will be posted to this channel.")
         await interaction.response.send_message(content, ephemeral=True)
-        # post calendar will commit
         await self.post_calendar(guild.id, channel)
 
     @group.command(name=_("discord"), description=("Post events to discord calendar."))
     async def calendar_discord(self, interaction: discord.Interaction):
-        if not self.is_raid_leader(interaction.user, interaction.guild):
+        if not await self.is_raid_leader(interaction.user, interaction.guild):
             await interaction.response.send_message(_("You must be a raid leader to change the calendar settings."), ephemeral=True)
             return
-        upsert(self.conn, 'Settings', ['calendar', 'guild_events'], [None, True], ['guild_id'], [interaction.guild_id])
+        await self.bot.settings.update(interaction.guild_id, ['calendar', 'guild_events'], [None, True])
+        await self.db.commit()
         content = _("Events will be posted as discord guild events.")
         await interaction.response.send_message(content, ephemeral=True)
-        self.conn.commit()
 
     @group.command(name=_("both"), description=("Post events to both discord and channel calendar."))
     async def calendar_both(self, interaction: discord.Interaction):
-        if not self.is_raid_leader(interaction.user, interaction.guild):
+        if not await self.is_raid_leader(interaction.user, interaction.guild):
             await interaction.response.send_message(_("You must be a raid leader to change the calendar settings."), ephemeral=True)
             return
         channel = interaction.channel
@@ -275,10 +455,10 @@ class CalendarCog(commands.Cog):
         if not (perms.send_messages and perms.embed_links):
             await interaction.response.send_message(_("Missing permissions to access this channel."))
             return
-        upsert(self.conn, 'Settings', ['guild_events'], [True], ['guild_id'], [guild.id])
+        await self.bot.settings.update(guild.id, ['guild_events'], [True])
+        await self.db.commit()
         content = _("Events will be posted to this channel and as discord guild events.")
         await interaction.response.send_message(content, ephemeral=True)
-        # post calendar will commit
         await self.post_calendar(guild.id, channel)
 
 
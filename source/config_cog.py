@@ -7,8 +7,6 @@ from discord import app_commands
 from discord.ext import commands
 from discord.utils import find
 
-from database import upsert
-
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 
@@ -16,7 +14,7 @@ logger.setLevel(logging.INFO)
 class ConfigCog(commands.Cog):
     def __init__(self, bot):
         self.bot = bot
-        self.conn = self.bot.conn
+        self.db = self.bot.db
 
     @staticmethod
     def td_format(td_object):
@@ -105,8 +103,8 @@ class ConfigCog(commands.Cog):
     async def on_guild_join(self, guild):
         logger.info("We have joined {0}.".format(guild))
         timestamp = int(datetime.datetime.now().timestamp())
-        upsert(self.conn, 'Settings', ['last_command'], [timestamp], ['guild_id'], [guild.id])
-        self.conn.commit()
+        await self.bot.settings.update(guild.id, ['last_command'], [timestamp])
+        await self.db.commit()
         channels = guild.text_channels
         channel = find(lambda x: x.name == 'welcome', channels)
         if not channel or not channel.permissions_for(guild.me).send_messages:
@@ -1,6 +1,11 @@
+import asyncio
+import collections
+from concurrent.futures import ThreadPoolExecutor
+import functools
 import json
 import logging
 import os
+import re
 import sqlite3
 
 logger = logging.getLogger(__name__)
@@ -19,16 +24,35 @@ except (FileNotFoundError, KeyError):
 classes_str = " boolean, ".join(classes) + " boolean, "
 
 
-def create_connection(db_file):
+def create_connection(db_file, pragmas=None):
     """ create a database connection to a SQLite database """
     conn = None
     try:
-        conn = sqlite3.connect(db_file)
+        # The connection is owned by the AsyncDatabase worker thread once the bot is running.
+        conn = sqlite3.connect(db_file, check_same_thread=False)
     except sqlite3.Error as e:
         logger.exception(e)
+    else:
+        if pragmas:
+            apply_pragmas(conn, pragmas)
     return conn
 
 
+def apply_pragmas(conn, pragmas):
+    """ configure the connection, e.g. {'journal_mode': 'WAL', 'synchronous': 'NORMAL'} """
+    c = conn.cursor()
+    for pragma, value in pragmas.items():
+        if not re.fullmatch(r'-?\w+', str(value)):
+            logger.warning("Ignoring invalid value {0} for pragma {1}.".format(value, pragma))
+            continue
+        try:
+            c.execute("pragma {0} = {1};".format(pragma, value))
+            c.execute("pragma {0};".format(pragma))
+            logger.info("Database {0}: {1}".format(pragma, c.fetchone()[0]))
+        except sqlite3.Error as e:
+            logger.exception(e)
+
+
 def create_table(conn, table):
     """ create a database table """
     sql = table_sqls(table)
@@ -39,6 +63,15 @@ def create_table(conn, table):
         logger.exception(e)
 
 
+def commit(conn):
+    """ commit the current transaction """
+    try:
+        conn.commit()
+        return True
+    except sqlite3.Error as e:
+        logger.exception(e)
+
+
 def table_sqls(table):
     sql_dict = {
             'raid': "create table if not exists Raids ("
@@ -95,52 +128,192 @@ def table_sqls(table):
             'twitter':  "create table if not exists Twitter ("
                         "user_id integer primary key,"
                         "tweet_id integer"
-                        ");"
+                        ");",
+
+            'events': "create table if not exists Events ("
+                      "name text not null, "
+                      "start_time integer not null, "
+                      "end_time integer not null"
+                      ");",
+
+            'events_source': "create table if not exists EventsSource ("
+                             "url text primary key, "
+                             "etag text, "
+                             "last_modified text, "
+                             "fetched_at integer"
+                             ");",
+
+            'fingerprint': "create table if not exists Fingerprints ("
+                           "message_id integer primary key, "
+                           "fingerprint text not null"
+                           ");"
     }
     return sql_dict[table]
 
 
+# Each entry upgrades the schema by one version, the current version is stored in the user_version pragma.
+migrations = [
+    [table_sqls(table) for table in ['raid', 'player', 'assign', 'timezone', 'settings', 'twitter']],
+    ["create index if not exists raids_guild_time on Raids (guild_id, time);",
+     "create index if not exists raids_time on Raids (time);",
+     "create index if not exists assignment_raid_player on Assignment (raid_id, player_id);"],
+    [table_sqls('events'), table_sqls('events_source')],
+    [table_sqls('fingerprint')],
+]
+
+
+def migrate(conn):
+    """ apply outstanding schema migrations and add columns for new classes
+
+    Each migration takes the write lock before checking the version, so processes starting together apply it once.
+    """
+    c = conn.cursor()
+    for number, steps in enumerate(migrations, start=1):
+        try:
+            c.execute("begin immediate;")
+            c.execute("pragma user_version;")
+            if number <= c.fetchone()[0]:
+                conn.commit()
+                continue
+            for sql in steps:
+                c.execute(sql)
+            c.execute("pragma user_version = {0};".format(number))
+            conn.commit()
+        except sqlite3.Error as e:
+            conn.rollback()
+            logger.exception(e)
+            logger.critical("Database migration to version {0} failed.".format(number))
+            return False
+        logger.info("Migrated database to version {0}.".format(number))
+    return add_class_columns(conn)
+
+
+def add_class_columns(conn):
+    """ add a column to Players for each class that was added to the config """
+    try:
+        c = conn.cursor()
+        c.execute("begin immediate;")
+        c.execute("pragma table_info(Players);")
+        columns = [row[1] for row in c.fetchall()]
+        for class_name in classes:
+            if class_name not in columns:
+                c.execute("alter table Players add column {0} boolean;".format(class_name))
+                logger.info("Added column for class {0}.".format(class_name))
+        conn.commit()
+        return True
+    except sqlite3.Error as e:
+        conn.rollback()
+        logger.exception(e)
+        return False
+
+
+def conditions(columns, operator="="):
+    return " and ".join([operator.join([column, "?"]) for column in columns])
+
+
+@functools.lru_cache(maxsize=None)
+def statement(operation, table, columns=(), where_columns=(), extra=None):
+    """ build the sql for an operation, memoised on (operation, table, column tuple, where-column tuple) """
+    if operation == 'update':
+        parts = ["update {0} set".format(table), ", ".join(["=".join([column, "?"]) for column in columns])]
+    elif operation == 'insert':
+        parts = ["insert into {0} (".format(table), ", ".join(columns), ") values (", ", ".join("?" * len(columns)),
+                 ")"]
+    elif operation == 'upsert':
+        insert_columns = columns + where_columns
+        updates = ", ".join(["{0}=excluded.{0}".format(column) for column in columns])
+        parts = ["insert into {0} (".format(table), ", ".join(insert_columns), ") values (",
+                 ", ".join("?" * len(insert_columns)), ") on conflict (", ", ".join(where_columns),
+                 ") do update set", updates]
+    elif operation == 'increment':
+        parts = ["update {0} set {1} = ifnull({1}, 0) + 1".format(table, columns[0])]
+    elif operation == 'delete':
+        parts = ["delete from {0}".format(table)]
+    elif operation == 'count':
+        parts = ["select count({1}) from {0}".format(table, columns[0])]
+    else:
+        parts = ["select", ", ".join(columns), "from {0}".format(table)]
+
+    if operation == 'select_one':
+        none_columns, like_columns = extra
+        where = []
+        if where_columns:
+            where.append(conditions(where_columns))
+        if none_columns:
+            where.append(" and ".join([column + " is null" for column in none_columns]))
+        if like_columns:
+            where.append(conditions(like_columns, " like "))
+        if where:
+            parts.extend(["where", " and ".join(where)])
+    elif where_columns and operation not in ['insert', 'upsert']:
+        operator = "<" if operation == 'select_le' else "="
+        parts.extend(["where", conditions(where_columns, operator)])
+    if operation == 'select_order':
+        parts.append("order by {0}".format(extra))
+    return " ".join(parts) + ";"
+
+
+# Upsert clause requires sqlite 3.24.0
+native_upsert = sqlite3.sqlite_version_info >= (3, 24, 0)
+constraints_cache = {}
+
+
+def table_constraints(conn, table):
+    """ return the primary key and the columns an insert must provide """
+    try:
+        return constraints_cache[table]
+    except KeyError:
+        pass
+    c = conn.cursor()
+    c.execute("pragma table_info({0});".format(table))
+    info = c.fetchall()
+    if not info:
+        # Table does not exist (yet), do not cache.
+        return (), frozenset()
+    primary_key = tuple(row[1] for row in sorted(info, key=lambda row: row[5]) if row[5])
+    required = frozenset(row[1] for row in info if row[3] and row[4] is None)
+    constraints_cache[table] = primary_key, required
+    return primary_key, required
+
+
 def upsert(conn, table, columns, values, where_columns=None, where_values=None):
     """ update or insert values """
     assert len(columns) == len(values)
-    updates = ["update {0} set".format(table), ", ".join(["=".join([column, "?"]) for column in columns])]
-    if where_columns:
-        assert len(where_columns) == len(where_values)
-        updates.append("where")
-        updates.append(" and ".join(["=".join([column, "?"]) for column in where_columns]))
-        update_values = values + where_values
-    else:
-        update_values = values
-    updates.append(";")
-    sql_update = " ".join(updates)
+    columns = tuple(columns)
+    sql_update = None
     try:
         c = conn.cursor()
+        if where_columns:
+            assert len(where_columns) == len(where_values)
+            where_columns = tuple(where_columns)
+            if native_upsert:
+                primary_key, required = table_constraints(conn, table)
+                # A single insert .. on conflict statement if the where clause is the primary key
+                # and the insert would satisfy the not null constraints.
+                if set(where_columns) == set(primary_key) and required.issubset(columns + where_columns):
+                    sql_update = statement('upsert', table, columns, where_columns)
+                    c.execute(sql_update, list(values) + list(where_values))
+                    return True
+            update_values = list(values) + list(where_values)
+        else:
+            where_columns = ()
+            update_values = values
+        sql_update = statement('update', table, columns, where_columns)
         c.execute(sql_update, update_values)
         if c.rowcount == 0:
-            if where_columns:
-                insert_columns = columns + where_columns
-                insert_values = values + where_values
-            else:
-                insert_columns = columns
-                insert_values = values
-            inserts = ["insert into {0} (".format(table), ", ".join(insert_columns), ") values (",
-                       ", ".join("?" * len(insert_values)), ");"]
-            sql_insert = " ".join(inserts)
-            c.execute(sql_insert, insert_values)
+            sql_update = statement('insert', table, columns + where_columns)
+            c.execute(sql_update, update_values)
         return True
     except sqlite3.Error as e:
         logger.exception(e)
         logger.info(sql_update)
 
+
 def increment(conn, table, column, where_columns=None, where_values=None):
     """ increment column value by 1 """
-    increments = ["update {0} set {1} = ifnull({1}, 0) + 1".format(table, column)]
     if where_columns:
         assert len(where_columns) == len(where_values)
-        increments.append("where")
-        increments.append(" and ".join(["=".join([column, "?"]) for column in where_columns]))
-    increments.append(";")
-    sql_increment = " ".join(increments)
+    sql_increment = statement('increment', table, (column,), tuple(where_columns or ()))
     try:
         c = conn.cursor()
         if where_values:
@@ -155,9 +328,7 @@ def increment(conn, table, column, where_columns=None, where_values=None):
 
 def delete(conn, table, where_columns, where_values):
     """ delete a record """
-    deletes = ["delete from {0} where".format(table),
-               " and ".join(["=".join([column, "?"]) for column in where_columns]), ";"]
-    sql_delete = " ".join(deletes)
+    sql_delete = statement('delete', table, (), tuple(where_columns))
     try:
         c = conn.cursor()
         c.execute(sql_delete, where_values)
@@ -167,14 +338,23 @@ def delete(conn, table, where_columns, where_values):
         logger.info(sql_delete)
 
 
+def replace_all(conn, table, columns, rows):
+    """ replace the contents of a table with rows """
+    sql_insert = statement('insert', table, tuple(columns))
+    try:
+        c = conn.cursor()
+        c.execute("delete from {0};".format(table))
+        c.executemany(sql_insert, rows)
+        return True
+    except sqlite3.Error as e:
+        logger.exception(e)
+        logger.info(sql_insert)
+
+
 def select(conn, table, columns, where_columns=None, where_values=None):
-    selects = ["select", ", ".join(columns), "from {0}".format(table)]
     if where_columns:
         assert len(where_columns) == len(where_values)
-        selects.append("where")
-        selects.append(" and ".join(["=".join([column, "?"]) for column in where_columns]))
-    selects.append(";")
-    sql_select = " ".join(selects)
+    sql_select = statement('select', table, tuple(columns), tuple(where_columns or ()))
     try:
         c = conn.cursor()
         if where_values:
@@ -189,23 +369,12 @@ def select(conn, table, columns, where_columns=None, where_values=None):
 
 
 def select_one(conn, table, columns, eq_columns=None, eq_values=None, none_columns=None, like_columns=None, like_values=None):
-    selects = ["select", ", ".join(columns), "from {0}".format(table)]
-    if eq_columns or none_columns or like_columns:
-        selects.append("where")
-        if eq_columns:
-            assert len(eq_columns) == len(eq_values)
-            selects.append(" and ".join(["=".join([column, "?"]) for column in eq_columns]))
-        if eq_columns and none_columns:
-            selects.append("and")
-        if none_columns:
-            selects.append(" and ".join([column + " is null" for column in none_columns]))
-        if (eq_columns or none_columns) and like_columns:
-            selects.append("and")
-        if like_columns:
-            assert len(like_columns) == len(like_values)
-            selects.append(" and ".join([" like ".join([column, "?"]) for column in like_columns]))
-    selects.append(";")
-    sql_select = " ".join(selects)
+    if eq_columns:
+        assert len(eq_columns) == len(eq_values)
+    if like_columns:
+        assert len(like_columns) == len(like_values)
+    extra = (tuple(none_columns or ()), tuple(like_columns or ()))
+    sql_select = statement('select_one', table, tuple(columns), tuple(eq_columns or ()), extra)
     try:
         c = conn.cursor()
         if eq_values or like_values:
@@ -228,13 +397,9 @@ def select_one(conn, table, columns, eq_columns=None, eq_values=None, none_colum
 
 
 def select_order(conn, table, columns, order, where_columns=None, where_values=None):
-    selects = ["select", ", ".join(columns), "from {0}".format(table)]
     if where_columns:
         assert len(where_columns) == len(where_values)
-        selects.append("where")
-        selects.append(" and ".join(["=".join([column, "?"]) for column in where_columns]))
-    selects.append("order by {0};".format(order))
-    sql_select = " ".join(selects)
+    sql_select = statement('select_order', table, tuple(columns), tuple(where_columns or ()), order)
     try:
         c = conn.cursor()
         if where_values:
@@ -249,13 +414,9 @@ def select_order(conn, table, columns, order, where_columns=None, where_values=N
 
 
 def select_le(conn, table, columns, where_columns=None, where_values=None):
-    selects = ["select", ", ".join(columns), "from {0}".format(table)]
     if where_columns:
         assert len(where_columns) == len(where_values)
-        selects.append("where")
-        selects.append(" and ".join(["<".join([column, "?"]) for column in where_columns]))
-    selects.append(";")
-    sql_select = " ".join(selects)
+    sql_select = statement('select_le', table, tuple(columns), tuple(where_columns or ()))
     try:
         c = conn.cursor()
         if where_values:
@@ -270,13 +431,9 @@ def select_le(conn, table, columns, where_columns=None, where_values=None):
 
 
 def count(conn, table, column, where_columns=None, where_values=None):
-    counts = ["select count({1}) from {0}".format(table, column)]
     if where_columns:
         assert len(where_columns) == len(where_values)
-        counts.append("where")
-        counts.append(" and ".join(["=".join([column, "?"]) for column in where_columns]))
-    counts.append(";")
-    sql_count = " ".join(counts)
+    sql_count = statement('count', table, (column,), tuple(where_columns or ()))
     try:
         c = conn.cursor()
         if where_values:
@@ -288,3 +445,98 @@ def count(conn, table, column, where_columns=None, where_values=None):
     except sqlite3.Error as e:
         logger.exception(e)
         logger.info(sql_count)
+
+
+RaidSnapshot = collections.namedtuple('RaidSnapshot', ['raid', 'players', 'assignments'])
+snapshot_raid_columns = ('raid_id', 'channel_id', 'guild_id', 'organizer_id', 'event_id', 'name', 'tier', 'boss', 'time',
+                         'roster')
+snapshot_assignment_columns = ('slot_id', 'player_id', 'byname', 'class_name')
+
+
+def load_raid_snapshot(conn, raid_id):
+    """ read a raid with its players and assignments in one transaction
+
+    Returns a RaidSnapshot of row tuples: raid in snapshot_raid_columns order, players as player_id, byname,
+    timestamp, unavailable followed by the class columns, and assignments ordered by slot_id. Returns None if the
+    raid does not exist.
+    """
+    player_columns = ('player_id', 'byname', 'timestamp', 'unavailable') + tuple(classes)
+    sql_raid = statement('select', 'Raids', snapshot_raid_columns, ('raid_id',))
+    sql_players = statement('select', 'Players', player_columns, ('raid_id',))
+    sql_assignments = statement('select_order', 'Assignment', snapshot_assignment_columns, ('raid_id',), 'slot_id')
+    # Uncommitted writes of our own already form a transaction the reads will see.
+    own_transaction = not conn.in_transaction
+    try:
+        c = conn.cursor()
+        if own_transaction:
+            c.execute("begin;")
+        raid = c.execute(sql_raid, [raid_id]).fetchone()
+        players = c.execute(sql_players, [raid_id]).fetchall()
+        assignments = c.execute(sql_assignments, [raid_id]).fetchall()
+        if own_transaction:
+            c.execute("commit;")
+    except sqlite3.Error as e:
+        logger.exception(e)
+        if own_transaction and conn.in_transaction:
+            conn.rollback()
+        return None
+    if raid is None:
+        return None
+    return RaidSnapshot(raid, tuple(players), tuple(assignments))
+
+
+class AsyncDatabase:
+    """ awaitable access to the database without blocking the event loop
+
+    All requests are queued on a single worker thread, which serialises them on the connection in the order they
+    were submitted. The methods mirror the module level functions, minus the connection argument.
+    """
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='raid_db')
+
+    async def run(self, func, *args, **kwargs):
+        """ run func(conn, *args, **kwargs) on the database thread """
+        loop = asyncio.get_running_loop()
+        call = functools.partial(func, self.conn, *args, **kwargs)
+        return await loop.run_in_executor(self.executor, call)
+
+    async def upsert(self, table, columns, values, where_columns=None, where_values=None):
+        return await self.run(upsert, table, columns, values, where_columns, where_values)
+
+    async def increment(self, table, column, where_columns=None, where_values=None):
+        return await self.run(increment, table, column, where_columns, where_values)
+
+    async def delete(self, table, where_columns, where_values):
+        return await self.run(delete, table, where_columns, where_values)
+
+    async def replace_all(self, table, columns, rows):
+        return await self.run(replace_all, table, columns, rows)
+
+    async def select(self, table, columns, where_columns=None, where_values=None):
+        return await self.run(select, table, columns, where_columns, where_values)
+
+    async def select_one(self, table, columns, eq_columns=None, eq_values=None, none_columns=None, like_columns=None,
+                         like_values=None):
+        return await self.run(select_one, table, columns, eq_columns, eq_values, none_columns, like_columns,
+                              like_values)
+
+    async def select_order(self, table, columns, order, where_columns=None, where_values=None):
+        return await self.run(select_order, table, columns, order, where_columns, where_values)
+
+    async def select_le(self, table, columns, where_columns=None, where_values=None):
+        return await self.run(select_le, table, columns, where_columns, where_values)
+
+    async def count(self, table, column, where_columns=None, where_values=None):
+        return await self.run(count, table, column, where_columns, where_values)
+
+    async def load_raid_snapshot(self, raid_id):
+        return await self.run(load_raid_snapshot, raid_id)
+
+    async def commit(self):
+        return await self.run(commit)
+
+    def close(self):
+        """ wait for queued requests to finish and release the worker thread """
+        self.executor.shutdown(wait=True)
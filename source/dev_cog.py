@@ -5,7 +5,6 @@ import discord
 import logging
 import psutil
 
-from database import delete, select
 from utils import chunks
 
 logger = logging.getLogger(__name__)
@@ -15,7 +14,7 @@ logger.setLevel(logging.INFO)
 class DevCog(commands.Cog):
     def __init__(self, bot):
         self.bot = bot
-        self.conn = bot.conn
+        self.db = bot.db
 
     @commands.command(hidden=True)
     @commands.is_owner()
@@ -85,6 +84,13 @@ class DevCog(commands.Cog):
             _("**Servers:** {0}").format(guild_count),
             _("**Members:** {0}").format(member_count)
         ]
+        raid_cog = self.bot.get_cog('RaidCog')
+        if raid_cog:
+            post_updates = raid_cog.post_updates
+            about.append(_("**Raid post edits:** {0} ({1} saved)").format(post_updates.runs, post_updates.saved))
+        about.append(_("**Unchanged edits skipped:** {0}").format(self.bot.fingerprints.skipped))
+        for name, histogram in sorted(self.bot.workers.histograms.items()):
+            about.append(_("**Latency of {0}:** {1}").format(name, histogram.summary()))
         content = "\n".join(about)
         embed = discord.Embed(title=title, colour=discord.Colour(0x3498db), description=content)
         await ctx.send(embed=embed)
@@ -100,7 +106,7 @@ class DevCog(commands.Cog):
     @commands.command(hidden=True)
     @commands.is_owner()
     async def cleanup(self, ctx):
-        res = select(self.conn, 'Settings', ['guild_id', 'last_command'])
+        res = [(settings.guild_id, settings.last_command) for settings in self.bot.settings.values()]
         current_time = datetime.datetime.now().timestamp()
         cutoff = 3600 * 24 * 90
         cutoff_time = current_time - cutoff
@@ -121,9 +127,9 @@ class DevCog(commands.Cog):
                     ## Don't immediately delete settings in case they rejoin.
             else:
                 logger.info("We are no longer in {0}".format(guild_id))
-                delete(self.conn, 'Settings', ['guild_id'], [guild_id])
+                await self.bot.settings.delete(guild_id)
+                await self.db.commit()
                 deleted += 1
-        self.conn.commit()
         logger.info("Active guild count: {0}".format(active))
         logger.info("Inactive guild count: {0}".format(inactive))
         logger.info("Deleted guild count: {0}".format(deleted))
@@ -0,0 +1,167 @@
+import hashlib
+import json
+import logging
+
+from utils import Coalescer
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+# Discord's embed limits
+FIELD_VALUE_LIMIT = 1024
+EMBED_TOTAL_LIMIT = 6000
+EMBED_FIELD_LIMIT = 25
+
+
+def pack_lines(lines, block_size=6, limit=FIELD_VALUE_LIMIT - 1):
+    """ pack lines into field values of at most block_size lines and limit characters in a single pass
+
+    Starts from as many fields as block_size requires. Longest lines are placed first, each into the shortest field
+    with room for it, so fields end up of similar length; a line that fits nowhere opens a new field.
+    """
+    number_of_fields = max((len(lines) - 1) // block_size + 1, 1)
+    fields = [[] for i in range(number_of_fields)]
+    lengths = [0] * number_of_fields
+    for line in sorted(lines, key=len, reverse=True):
+        index = None
+        for i, length in enumerate(lengths):
+            if len(fields[i]) < block_size and length + len(line) <= limit:
+                if index is None or length < lengths[index]:
+                    index = i
+        if index is None:
+            fields.append([])
+            lengths.append(0)
+            index = len(fields) - 1
+        fields[index].append(line)
+        lengths[index] += len(line)
+    return ["".join(field) for field in fields]
+
+
+def section_fields(name, values):
+    """ return (name, value) fields for a section, only the first field carries the section name """
+    return [(name if i == 0 else "\u200B", value) for i, value in enumerate(values)]
+
+
+def fit_fields(embed, fields, note=None):
+    """ add (name, value) fields to embed in order while it stays within Discord's limits
+
+    Returns the fields that were left out. If any were left out and note is given, note(left_out) must return a
+    (name, value) field which is added last; more fields are left out if that is needed to make room for it.
+    """
+    size = len(embed)
+    count = len(embed.fields)
+    added = 0
+    for name, value in fields:
+        if count + 1 > EMBED_FIELD_LIMIT or size + len(name) + len(value) > EMBED_TOTAL_LIMIT:
+            break
+        embed.add_field(name=name, value=value)
+        size += len(name) + len(value)
+        count += 1
+        added += 1
+    left_out = fields[added:]
+    while left_out and note:
+        name, value = note(left_out)
+        if count + 1 <= EMBED_FIELD_LIMIT and size + len(name) + len(value) <= EMBED_TOTAL_LIMIT:
+            embed.add_field(name=name, value=value, inline=False)
+            break
+        if not added:
+            logger.warning("No room left in the embed for the overflow note.")
+            break
+        embed.remove_field(len(embed.fields) - 1)
+        added -= 1
+        count -= 1
+        size -= len(fields[added][0]) + len(fields[added][1])
+        left_out = fields[added:]
+    return left_out
+
+
+def paginate(new_embed, fields):
+    """ spread fields over as many embeds from new_embed() as needed, returns the list of embeds """
+    pages = []
+    while True:
+        embed = new_embed()
+        left_out = fit_fields(embed, fields)
+        if len(left_out) == len(fields) and fields:
+            logger.warning("Field does not fit in an empty embed: {0}".format(fields[0][0]))
+            left_out = left_out[1:]
+        pages.append(embed)
+        if not left_out:
+            return pages
+        fields = left_out
+
+
+def fingerprint(embed, ignore=()):
+    """ hash the embed's content, leaving out the top level keys in ignore, e.g. 'timestamp' """
+    content = embed.to_dict()
+    for key in ignore:
+        content.pop(key, None)
+    data = json.dumps(content, sort_keys=True, separators=(',', ':')).encode()
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+
+class RenderCache:
+    """ the fingerprint of what was last rendered to each message, so unchanged messages need not be edited
+
+    With a database the fingerprints are also kept in the Fingerprints table and survive a restart. Changes are written
+    in batches, at most one per flush_delay seconds, and each batch is committed. Give it a connection of its own so
+    those commits never include anybody else's writes.
+    """
+    flush_delay = 60
+
+    def __init__(self, db=None):
+        self.db = db
+        self.fingerprints = {}
+        # Changes not yet written, message id to fingerprint or None for a deleted row.
+        self.pending = {}
+        self.flushes = Coalescer(lambda key: self.flush(), self.flush_delay)
+        self.skipped = 0
+
+    async def load(self):
+        if not self.db:
+            return
+        rows = await self.db.select('Fingerprints', ['message_id', 'fingerprint'])
+        self.fingerprints = dict(rows or [])
+        logger.info("Loaded {0} render fingerprints.".format(len(self.fingerprints)))
+
+    def unchanged(self, message_id, digest):
+        if self.fingerprints.get(message_id) == digest:
+            self.skipped += 1
+            return True
+        return False
+
+    async def remember(self, message_id, digest):
+        self.fingerprints[message_id] = digest
+        self.write(message_id, digest)
+
+    async def forget(self, message_id):
+        if self.fingerprints.pop(message_id, None) is not None:
+            self.write(message_id, None)
+
+    def write(self, message_id, digest):
+        if self.db:
+            self.pending[message_id] = digest
+            self.flushes.schedule('fingerprints')
+
+    async def flush(self):
+        """ write and commit the pending changes """
+        batch = dict(self.pending)
+        if not batch:
+            return
+        for message_id, digest in batch.items():
+            if digest is None:
+                await self.db.delete('Fingerprints', ['message_id'], [message_id])
+            else:
+                await self.db.upsert('Fingerprints', ['fingerprint'], [digest], ['message_id'], [message_id])
+        await self.db.commit()
+        # Keep whatever changed again while this batch was written for the next one.
+        for message_id, digest in batch.items():
+            if message_id in self.pending and self.pending[message_id] == digest:
+                del self.pending[message_id]
+
+    async def close(self):
+        """ write what is pending and release the database """
+        if not self.db:
+            return
+        self.flushes.cancel()
+        await self.flush()
+        self.db.close()
@@ -0,0 +1,61 @@
+import logging
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+
+class GuildSettings:
+    """ a guild's row in Settings
+
+    server: time zone name, raid_leader and priority: role ids, calendar: "channel_id/message_id",
+    guild_events: whether to create discord events, twitter: channel id, last_command and slash_count: integers.
+    Unset values are None.
+    """
+    columns = ('server', 'raid_leader', 'priority', 'calendar', 'guild_events', 'twitter', 'last_command',
+               'slash_count')
+    __slots__ = ('guild_id',) + columns
+
+    def __init__(self, guild_id, *values):
+        self.guild_id = guild_id
+        for i, column in enumerate(self.columns):
+            setattr(self, column, values[i] if i < len(values) else None)
+
+
+class SettingsCache:
+    """ every guild's settings in memory, loaded in one query and written through to the database
+
+    Only guilds for which guild_filter(guild_id) is true are loaded. Committing remains up to the caller.
+    """
+
+    def __init__(self, db, guild_filter=None):
+        self.db = db
+        self.guild_filter = guild_filter
+        self.guilds = {}
+
+    async def load(self):
+        rows = await self.db.select('Settings', ['guild_id'] + list(GuildSettings.columns))
+        self.guilds = {row[0]: GuildSettings(*row) for row in rows or []
+                       if self.guild_filter is None or self.guild_filter(row[0])}
+        logger.info("Loaded settings for {0} guilds.".format(len(self.guilds)))
+
+    def get(self, guild_id):
+        """ return the guild's settings, or the defaults if it has none """
+        try:
+            return self.guilds[guild_id]
+        except KeyError:
+            return GuildSettings(guild_id)
+
+    def values(self):
+        return list(self.guilds.values())
+
+    async def update(self, guild_id, columns, values):
+        res = await self.db.upsert('Settings', columns, values, ['guild_id'], [guild_id])
+        if res and (self.guild_filter is None or self.guild_filter(guild_id)):
+            settings = self.guilds.setdefault(guild_id, GuildSettings(guild_id))
+            for column, value in zip(columns, values):
+                setattr(settings, column, value)
+        return res
+
+    async def delete(self, guild_id):
+        self.guilds.pop(guild_id, None)
+        return await self.db.delete('Settings', ['guild_id'], [guild_id])
@@ -1,19 +1,18 @@
 import asyncio
-import csv
 import datetime
 import discord
 from discord import app_commands
 from discord.ext import commands
-from discord.ext import tasks
 import logging
 import re
-import requests
 import time
 from typing import Optional
 
-from database import create_table, count, delete, select, select_le, select_one, select_order, upsert
+from embed_layout import fingerprint, fit_fields, pack_lines, paginate, section_fields
+from raid_names import match_raid_name, raid_lookup
+from raid_state import RaidRegistry, RaidState
 from time_cog import Time
-from utils import get_match
+from utils import Coalescer, Scheduler
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
@@ -21,38 +20,31 @@ logger.setLevel(logging.INFO)
 
 class RaidCog(commands.Cog):
 
-    # Load raid (nick)names
-    with open('list-of-raids.csv', 'r') as f:
-        reader = csv.reader(f)
-        raid_lookup = dict(reader)
+    # Raid (nick)names
+    raid_lookup = raid_lookup
     nicknames = list(raid_lookup.keys())
 
+    expiry_time = 7200  # Delete raids after 2 hours.
+    notify_time = 300  # Notify raiders 5 minutes before.
+
     def __init__(self, bot):
         self.bot = bot
-        self.conn = bot.conn
+        self.db = bot.db
         self.role_names = bot.role_names
         self.slots_class_names = bot.slots_class_names
         self.time_cog = bot.get_cog('TimeCog')
         self.calendar_cog = bot.get_cog('CalendarCog')
-
-        create_table(self.conn, 'raid')
-        create_table(self.conn, 'player')
-        create_table(self.conn, 'assign')
-
-        raids = select(self.conn, 'Raids', ['raid_id'])
-        self.raids = [raid[0] for raid in raids]
-        logger.info("We have loaded {} raids in memory.".format(len(self.raids)))
-        # Emojis
-        host_guild = bot.get_guild(bot.host_id)
-        if not host_guild:
-            # Use first guild as host
-            host_guild = bot.guilds[0]
-        logger.info("Using emoji from {0}.".format(host_guild))
-        self.class_emojis = [emoji for emoji in host_guild.emojis if emoji.name in self.role_names]
-        self.class_emojis_dict = {emoji.name: str(emoji) for emoji in self.class_emojis}
-
-        # Add raid view
-        self.bot.add_view(RaidView(self))
+        self.raids = RaidRegistry()
+        # Button presses arriving in quick succession share a single edit of the raid post.
+        self.post_updates = Coalescer(self.edit_raid_post, 1)
+        self.deadlines = Scheduler(self.raid_deadline)
+
+        # Emojis, loaded from the host guild in cog_load.
+        self.class_emojis = []
+        self.class_emojis_dict = {}
+        # Rendered emoji strings by class bitmask and by slot class names.
+        self.class_emoji_strings = {}
+        self.slot_emoji_strings = {}
 
         # Add raid commands to tree
         @app_commands.guild_only()
@@ -74,10 +66,36 @@ class RaidCog(commands.Cog):
             self.bot.tree.add_command(command)
 
     async def cog_load(self):
-        self.background_task.start()
+        await self.load_emojis()
+        # Add raid view
+        self.bot.add_view(RaidView(self))
+
+        # Raids in guilds on other processes' shards are handled by those processes.
+        raids = await RaidState.load_all(self.db, self.role_names, self.bot.owns_guild)
+        self.raids = RaidRegistry(raids.values())
+        logger.info("We have loaded {} raids in memory.".format(len(self.raids)))
+        for raid in self.raids.values():
+            self.schedule_raid(raid)
+        self.deadlines.start()
 
     async def cog_unload(self):
-        self.background_task.cancel()
+        self.deadlines.cancel()
+        self.post_updates.cancel()
+
+    async def load_emojis(self):
+        host_guild = self.bot.get_guild(self.bot.host_id)
+        if not host_guild and self.bot.host_id:
+            # The host guild can be on a shard run by another process.
+            try:
+                host_guild = await self.bot.fetch_guild(self.bot.host_id)
+            except discord.HTTPException as e:
+                logger.warning(e)
+        if not host_guild:
+            # Use first guild as host
+            host_guild = self.bot.guilds[0]
+        logger.info("Using emoji from {0}.".format(host_guild))
+        self.class_emojis = [emoji for emoji in host_guild.emojis if emoji.name in self.role_names]
+        self.class_emojis_dict = {emoji.name: str(emoji) for emoji in self.class_emojis}
 
     async def handle_raid_command(self, interaction, name, tier, time, aim):
             new_raid = False
@@ -88,7 +106,7 @@ class RaidCog(commands.Cog):
                 content = _("Missing permissions to access this channel.")
             else:
                 try:
-                    timestamp = Time().converter(self.bot, guild.id, interaction.user.id, time)
+                    timestamp = await Time().converter(self.bot, guild.id, interaction.user.id, time)
                 except commands.BadArgument as e:
                     content = str(e)
                 else:
@@ -129,8 +147,8 @@ class RaidCog(commands.Cog):
                 role_id = role.id
             else:
                 role_id = None
-            res = upsert(self.conn, 'Settings', ['raid_leader'], [role_id], ['guild_id'], [interaction.guild_id])
-            self.conn.commit()
+            res = await self.bot.settings.update(interaction.guild_id, ['raid_leader'], [role_id])
+            await self.db.commit()
             if role:
                 await interaction.response.send_message(_("Set the raid leader role to {0}.").format(role.mention), allowed_mentions=discord.AllowedMentions.none())
             else:
@@ -147,8 +165,8 @@ class RaidCog(commands.Cog):
                 role_id = role.id
             else:
                 role_id = None
-            res = upsert(self.conn, 'Settings', ['priority'], [role_id], ['guild_id'], [interaction.guild_id])
-            self.conn.commit()
+            res = await self.bot.settings.update(interaction.guild_id, ['priority'], [role_id])
+            await self.db.commit()
             if role:
                 await interaction.response.send_message(_("Set the kin role to {0}.").format(role.mention), allowed_mentions=discord.AllowedMentions.none())
             else:
@@ -170,19 +188,20 @@ class RaidCog(commands.Cog):
     @app_commands.describe(raid_number=_("Specify the raid to list, e.g. 2 for the second upcoming raid. This defaults to 1 if omitted."), cut_off=_("Specify cut-off time in hours before raid time. This defaults to 24 hours if omitted."))
     @app_commands.guild_only()
     async def list_respond(self, interaction: discord.Interaction, raid_number: Optional[int]=1, cut_off: Optional[int]=24):
-        if not self.calendar_cog.is_raid_leader(interaction.user, interaction.guild):
+        if not await self.calendar_cog.is_raid_leader(interaction.user, interaction.guild):
             await interaction.response.send_message(_("You must be a raid leader to list players."))
             return
-        conn = self.conn
-        raids = select_order(conn, 'Raids', ['raid_id', 'name', 'time'], 'time', ['guild_id'], [interaction.guild_id])
+        raids = self.raids.guild_raids(interaction.guild_id)
         if raid_number > len(raids):
             await interaction.response.send_message(_("Cannot list raid {0}: only {1} raids exist.").format(raid_number, len(raids)))
             return
         elif raid_number < 1:
             await interaction.response.send_message(_("Please provide a positive integer."))
             return
-        raid_id, raid_name, raid_time = raids[raid_number-1]
-        player_data = select_order(conn, 'Players', ['byname', 'timestamp'], 'timestamp', ['raid_id', 'unavailable'], [raid_id, False])
+        raid = raids[raid_number-1]
+        raid_name = raid.name
+        raid_time = raid.time
+        player_data = sorted(raid.available_players(), key=lambda player: player.timestamp or 0)
 
         # build the embed
         cutoff_time = raid_time - 3600 * cut_off
@@ -192,17 +211,17 @@ class RaidCog(commands.Cog):
         players_off = ["\u200b"]
         times_on = ["\u200b"]
         times_off = ["\u200b"]
-        for row in player_data:
-            if row[1]:
-                time = row[1]
+        for player in player_data:
+            if player.timestamp:
+                time = player.timestamp
                 if time < cutoff_time:
-                    players_on.append(row[0])
+                    players_on.append(player.byname)
                     times_on.append(f"<t:{time}:R>")
                 else:
-                    players_off.append(row[0])
+                    players_off.append(player.byname)
                     times_off.append(f"<t:{time}:R>")
             else:
-                players_on.append(row[0])
+                players_on.append(player.byname)
                 times_on.append("\u200b")
         players_on = "\n".join(players_on)
         players_off = "\n".join(players_off)
@@ -216,18 +235,17 @@ class RaidCog(commands.Cog):
         embed.add_field(name="\u200b", value="\u200b")
         await interaction.response.send_message(embed=embed)
 
-    def get_raid_name(self, name):
+    async def get_raid_name(self, name):
         try:
             name = self.raid_lookup[name.lower()]
         except KeyError:
-            names = list(self.raid_lookup.values())
-            match = get_match(name, names)
+            match = await self.bot.workers.run('raid name resolution', match_raid_name, name)
             if match[0]:
                 name = match[0]
         return name
 
     async def post_raid(self, name, tier, boss, timestamp, roster, guild_id, channel, author_id):
-        full_name = self.get_raid_name(name)
+        full_name = await self.get_raid_name(name)
         raid_time = datetime.datetime.utcfromtimestamp(timestamp)
         # Check if time is in near future. Otherwise parsed date was likely unintended.
         current_time = int(time.time())
@@ -237,47 +255,65 @@ class RaidCog(commands.Cog):
             await channel.send(error_message, delete_after=30)
         post = await channel.send('\u200B')
         raid_id = post.id
-        raid_columns = ['channel_id', 'guild_id', 'organizer_id', 'name', 'tier', 'boss', 'time', 'roster']
-        raid_values = [channel.id, guild_id, author_id, full_name, tier, boss, timestamp, roster]
-        upsert(self.conn, 'Raids', raid_columns, raid_values, ['raid_id'], [raid_id])
-        self.roster_init(raid_id)
-        embed = self.build_raid_message(raid_id, "\u200B", None)
+        raid = RaidState(self.db, self.role_names, raid_id, channel.id, guild_id, author_id, None, full_name, tier,
+                         boss, timestamp, roster)
+        await raid.insert()
+        await self.roster_init(raid)
+        self.raids.add(raid)
+        self.schedule_raid(raid)
+        await self.db.commit()
+        embed = self.build_raid_message(raid, "\u200B", None)[0]
         await post.edit(embed=embed, view=RaidView(self))
-        self.raids.append(raid_id)
-        await self.create_guild_event(channel, raid_id)
-        self.conn.commit()
+        await self.bot.fingerprints.remember(raid_id, fingerprint(embed))
+        await self.create_guild_event(channel, raid)
+        await self.db.commit()
         logger.info("Created new raid: {0} at {1} for guild {2}.".format(full_name, raid_time, guild_id))
-        await self.calendar_cog.update_calendar(guild_id)
+        self.calendar_cog.update_calendar(guild_id)
 
-    async def create_guild_event(self, channel, raid_id):
+    async def create_guild_event(self, channel, raid):
         try:
-            event_id = self.calendar_cog.create_guild_event(raid_id)
-        except requests.HTTPError as e:
-            logger.warning(e.response.text)
+            event_id = await self.calendar_cog.create_guild_event(raid)
+        except discord.HTTPException as e:
+            logger.warning(e.text)
             err_msg = _("Failed to create the discord event. Please check the bot has the manage event permission.")
             await channel.send(err_msg, delete_after=20)
-        except requests.exceptions.JSONDecodeError as e:
+        except (KeyError, TypeError):
             err_msg = _("Invalid response from Discord.")
             await channel.send(err_msg, delete_after=20)
         else:
-            upsert(self.conn, 'Raids', ['event_id'], [event_id], ['raid_id'], [raid_id])
+            await raid.update(['event_id'], [event_id])
 
-    def roster_init(self, raid_id):
-        available = _("<Open>")
-        assignment_columns = ['player_id', 'byname', 'class_name']
+    async def roster_init(self, raid):
         for i in range(len(self.slots_class_names)):
-            assignment_values = [None, available, ','.join(self.slots_class_names[i])]
-            upsert(self.conn, 'Assignment', assignment_columns, assignment_values, ['raid_id', 'slot_id'], [raid_id, i])
+            await self.clear_slot(raid, i)
+
+    async def clear_slot(self, raid, slot_id):
+        class_names = ','.join(self.slots_class_names[slot_id])
+        await raid.assign(slot_id, None, _("<Open>"), class_names)
+
+    async def get_raid(self, raid_id):
+        """ return the raid from memory, falling back to the database for raids missing from the registry """
+        raid = self.raids.get(raid_id)
+        if raid is None:
+            raid = await RaidState.load(self.db, self.role_names, raid_id)
+            if raid and raid_id in self.raids:
+                # Loaded concurrently by another interaction.
+                raid = self.raids.get(raid_id)
+            elif raid:
+                logger.warning("Raid {0} was missing from memory.".format(raid_id))
+                self.raids.add(raid)
+                self.schedule_raid(raid)
+        return raid
 
     async def has_raid_permission(self, user, guild, raid_id, channel=None):
         if user.guild_permissions.administrator:
             return True
 
-        organizer_id = select_one(self.conn, 'Raids', ['organizer_id'], ['raid_id'], [raid_id])
-        if organizer_id == user.id:
+        raid = self.raids.get(raid_id)
+        if raid and raid.organizer_id == user.id:
             return True
 
-        raid_leader_id = select_one(self.conn, 'Settings', ['raid_leader'], ['guild_id'], [guild.id])
+        raid_leader_id = self.bot.settings.get(guild.id).raid_leader
         if raid_leader_id:
             raid_leader = guild.get_role(raid_leader_id)
             if raid_leader in user.roles:
@@ -287,15 +323,29 @@ class RaidCog(commands.Cog):
             await channel.send(perm_msg, delete_after=15)
         return False
 
-    async def update_raid_post(self, raid_id, channel):
-        available = self.build_raid_players(raid_id)
-        unavailable = self.build_raid_players(raid_id, available=False)
-        embed = self.build_raid_message(raid_id, available, unavailable)
-        if not embed:
+    def update_raid_post(self, raid_id, channel):
+        self.post_updates.schedule(raid_id, channel)
+
+    async def edit_raid_post(self, raid_id, channel):
+        raid = self.raids.get(raid_id)
+        if not raid:
+            logger.info("The raid has been deleted during editing.")
+            return
+        available = self.build_raid_players(raid)
+        unavailable = self.build_raid_players(raid, available=False)
+        embed, left_out = self.build_raid_message(raid, available, unavailable)
+        digest = fingerprint(embed)
+        if self.bot.fingerprints.unchanged(raid_id, digest):
             return
         post = channel.get_partial_message(raid_id)
         try:
-            await post.edit(embed=embed)
+            if left_out:
+                # The overflow note points to the player list button, which posts older than it only get with the
+                # view. Edits do not send the view otherwise.
+                await post.edit(embed=embed, view=RaidView(self))
+            else:
+                await post.edit(embed=embed)
+            await self.bot.fingerprints.remember(raid_id, digest)
         except discord.HTTPException as e:
             logger.warning(e)
             msg = "The above error occurred sending the following messages as embed:"
@@ -303,193 +353,194 @@ class RaidCog(commands.Cog):
             logger.warning(error_msg)
             await channel.send(_("That's an error. Check the logs."))
 
-    def build_raid_message(self, raid_id, embed_texts_av, embed_texts_unav):
-        try:
-            name, tier, time, boss, roster = select_one(self.conn, 'Raids', ['name', 'tier', 'time', 'boss', 'roster'],
-                                                    ['raid_id'], [raid_id])
-        except TypeError:
-            logger.info("The raid has been deleted during editing.")
-            return
-        timestamp = int(time)
-        number_of_players = count(self.conn, 'Players', 'player_id', ['raid_id', 'unavailable'], [raid_id, False])
+    @staticmethod
+    def raid_title(raid):
+        if raid.tier:
+            return f"{raid.name} {raid.tier}\n<t:{raid.time}:F>"
+        return f"{raid.name}\n<t:{raid.time}:F>"
 
-        if tier:
-            embed_title = f"{name} {tier}\n<t:{timestamp}:F>"
-        else:
-            embed_title = f"{name}\n<t:{timestamp}:F>"
+    def build_raid_message(self, raid, embed_texts_av, embed_texts_unav):
+        """ return the raid post's embed and the player fields that did not fit in it """
+        boss = raid.boss
+        embed_title = self.raid_title(raid)
         if boss:
             embed_description = _("Aim: {0}").format(boss)
         else:
             embed_description = ""
 
         embed = discord.Embed(title=embed_title, colour=discord.Colour(0x3498db), description=embed_description)
-        if roster:
-            result = select(self.conn, 'Assignment', ['byname, class_name'], ['raid_id'], [raid_id])
+        if raid.roster:
+            result = raid.slots
             number_of_slots = len(result)
             # Add first half
             embed_name = _("Selected line up:")
             embed_text = ""
             for row in result[:number_of_slots // 2]:
-                class_names = row[1].split(',')
-                for class_name in class_names:
-                    embed_text = embed_text + self.class_emojis_dict[class_name]
-                embed_text = embed_text + ": " + row[0] + "\n"
+                embed_text = embed_text + self.slot_emoji_string(row[2]) + ": " + row[1] + "\n"
             embed.add_field(name=embed_name, value=embed_text)
             # Add second half
             embed_name = "\u200B"
             embed_text = ""
             for row in result[number_of_slots // 2:]:
-                class_names = row[1].split(',')
-                for class_name in class_names:
-                    embed_text = embed_text + self.class_emojis_dict[class_name]
-                embed_text = embed_text + ": " + row[0] + "\n"
+                embed_text = embed_text + self.slot_emoji_string(row[2]) + ": " + row[1] + "\n"
             embed.add_field(name=embed_name, value=embed_text)
             embed.add_field(name="\u200B", value="\u200B")
-        # Add a field for each embed text
-        for i in range(len(embed_texts_av)):
-            if i == 0:
-                embed_name = _("The following {0} players are available:").format(number_of_players)
-            else:
-                embed_name = "\u200B"
-            embed.add_field(name=embed_name, value=embed_texts_av[i])
+        fields = self.player_fields(raid, embed_texts_av, embed_texts_unav)
+        left_out = fit_fields(embed, fields, note=self.overflow_note)
+        return embed, left_out
+
+    def player_fields(self, raid, embed_texts_av, embed_texts_unav):
+        """ return the (name, value) fields listing the players """
+        embed_name = _("The following {0} players are available:").format(len(raid.available_players()))
+        fields = section_fields(embed_name, embed_texts_av)
         if len(embed_texts_av) == 1:
-            embed.add_field(name="\u200B", value="\u200B")
+            fields.append(("\u200B", "\u200B"))
         if embed_texts_unav:
-            number_of_unav_players = count(self.conn, 'Players', 'player_id', ['raid_id', 'unavailable'],
-                                           [raid_id, True])
-            for i in range(len(embed_texts_unav)):
-                if i == 0:
-                    embed_name = _("The following {0} players are unavailable:").format(number_of_unav_players)
-                else:
-                    embed_name = "\u200B"
-                embed.add_field(name=embed_name, value=embed_texts_unav[i])
-        return embed
+            embed_name = _("The following {0} players are unavailable:").format(len(raid.unavailable_players()))
+            fields.extend(section_fields(embed_name, embed_texts_unav))
+        return fields
+
+    def overflow_note(self, left_out):
+        number_of_players = sum(value.count("\n") for name, value in left_out)
+        name = _("Too many sign ups to show:")
+        value = _("{0} more players are not listed, press \U0001F4CB to see everyone.").format(number_of_players)
+        return name, value
+
+    def build_player_pages(self, raid):
+        """ return embeds listing all players of the raid, spread over pages where needed """
+        available = self.build_raid_players(raid)
+        unavailable = self.build_raid_players(raid, available=False)
+        fields = self.player_fields(raid, available, unavailable)
+        title = self.raid_title(raid)
+        return paginate(lambda: discord.Embed(title=title, colour=discord.Colour(0x3498db)), fields)
+
+    def class_emoji_string(self, raid, mask):
+        """ return the emojis for the classes in the bitmask, built once per combination """
+        try:
+            return self.class_emoji_strings[mask]
+        except KeyError:
+            emojis = "".join(self.class_emojis_dict[name] for name in raid.class_names(mask))
+            self.class_emoji_strings[mask] = emojis
+            return emojis
 
-    def build_raid_players(self, raid_id, available=True, block_size=6):
-        columns = ['raid_id', 'player_id', 'byname']
+    def slot_emoji_string(self, class_names):
+        """ return the emojis for a slot's comma separated class names """
+        try:
+            return self.slot_emoji_strings[class_names]
+        except KeyError:
+            emojis = "".join(self.class_emojis_dict[name] for name in class_names.split(','))
+            self.slot_emoji_strings[class_names] = emojis
+            return emojis
+
+    def player_line(self, raid, player):
+        """ return the player's line in the raid post, cached until their sign up changes """
+        if player.line is None:
+            if player.unavailable:
+                player.line = "\u274C " + player.byname + "\n"
+            else:
+                player.line = player.byname + " " + self.class_emoji_string(raid, player.classes) + "\n"
+        return player.line
+
+    def build_raid_players(self, raid, available=True, block_size=6):
         if available:
-            columns.extend(self.role_names)
-        unavailable = (int(available) + 1) % 2
-        result = select(self.conn, 'Players', columns, ['raid_id', 'unavailable'], [raid_id, unavailable])
-        player_strings = []
-        if result:
-            number_of_players = len(result)
-            number_of_fields = ((number_of_players - 1) // block_size) + 1
-            # Create the player strings
-            for row in result:
-                i = 2
-                if available:
-                    player_string = row[i] + " "
-                    for name in self.role_names:
-                        i = i + 1
-                        if row[i]:
-                            player_string = player_string + self.class_emojis_dict[name]
-                else:
-                    player_string = "\u274C " + row[i]
-                player_string = player_string + "\n"
-                player_strings.append(player_string)
-            # Sort the strings by length
-            player_strings.sort(key=len, reverse=True)
+            players = raid.available_players()
         else:
-            if not available:
+            players = raid.unavailable_players()
+            if not players:
                 return None
-            number_of_players = 0
-            number_of_fields = 1
-        # Compute number of fields
-        msg = [""] * number_of_fields
-        # Add the players to the fields, spreading large strings.
-        number_of_players_added = 0
-        remainder = number_of_players % block_size
-        if remainder:
-            cap_index_last_field = number_of_fields * remainder
-        else:
-            cap_index_last_field = number_of_fields * block_size
-        for player_string in player_strings:
-            if number_of_players_added < cap_index_last_field:
-                index = number_of_players_added % number_of_fields
-            else:
-                index = number_of_players_added % (number_of_fields - 1)
-            number_of_players_added = number_of_players_added + 1
-            msg[index] = msg[index] + player_string
+        lines = [self.player_line(raid, player) for player in players]
+        msg = pack_lines(lines, block_size)
         # Do not send an empty embed if there are no players.
         if msg[0] == "":
             msg[0] = "\u200B"
-        # Check if the length does not exceed embed limit and split if we can.
-        if len(max(msg, key=len)) >= 1024 and block_size >= 2:
-            msg = self.build_raid_players(raid_id, block_size=block_size // 2)
         return msg
 
-    @tasks.loop(seconds=300)
-    async def background_task(self):
-        bot = self.bot
-        expiry_time = 7200  # Delete raids after 2 hours.
-        notify_time = 300  # Notify raiders 5 minutes before.
-        current_time = datetime.datetime.now().timestamp()
+    def schedule_raid(self, raid):
+        """ queue the notification and expiry deadlines for the raid's current time """
+        self.deadlines.add(raid.time - self.notify_time, 'notify', raid.raid_id, raid.time)
+        self.deadlines.add(raid.time + self.expiry_time, 'expire', raid.raid_id, raid.time)
 
-        cutoff = current_time + 2 * notify_time
-        raids = select_le(self.conn, 'Raids', ['raid_id', 'channel_id', 'time', 'roster'], ['time'], [cutoff])
-        for raid in raids:
-            raid_id = int(raid[0])
-            channel_id = int(raid[1])
-            timestamp = int(raid[2])
-            roster = int(raid[3])
-            channel = bot.get_channel(channel_id)
-            if not channel:
-                await self.cleanup_old_raid(raid_id, "Raid channel has been deleted.")
-                continue
+    async def raid_deadline(self, kind, raid_id, timestamp):
+        raid = self.raids.get(raid_id)
+        if not raid or raid.time != timestamp:
+            # Raid was deleted or rescheduled since this deadline was queued.
+            return
+        current_time = datetime.datetime.now().timestamp()
+        if kind == 'notify' and current_time > timestamp:
+            # Do not announce raids that already started, e.g. after downtime.
+            return
+        channel = self.bot.get_channel(raid.channel_id)
+        if not channel:
+            await self.cleanup_old_raid(raid_id, "Raid channel has been deleted.")
+            await self.db.commit()
+        elif kind == 'expire':
+            await self.cleanup_old_raid(raid_id, "Deleted expired raid post.")
+            await self.db.commit()
+            post = channel.get_partial_message(raid_id)
             try:
-                post = await channel.fetch_message(raid_id)
+                await post.delete()
             except discord.NotFound:
-                await self.cleanup_old_raid(raid_id, "Raid post already deleted.")
+                logger.info("Raid post already deleted.")
             except discord.Forbidden:
-                await self.cleanup_old_raid(raid_id, "We are missing required permissions to see raid post.")
-            else:
-                if current_time > timestamp + expiry_time:
-                    await self.cleanup_old_raid(raid_id, "Deleted expired raid post.")
-                    await post.delete()
-                elif current_time < timestamp - notify_time:
-                    raid_start_msg = _("Gondor calls for aid! Will you answer the call")
-                    if roster:
-                        players = select(self.conn, 'Assignment', ['player_id'], ['raid_id'], [raid_id])
-                        player_msg = " ".join(["<@{0}>".format(player[0]) for player in players if player[0]])
-                        raid_start_msg = " ".join([raid_start_msg, player_msg])
-                    raid_start_msg = raid_start_msg + _("? We are forming for the raid now.")
-                    try:
-                        await channel.send(raid_start_msg, delete_after=notify_time * 2)
-                    except discord.Forbidden:
-                        logger.warning("Missing permissions to send raid notification to channel {0}".format(channel.id))
-
-        self.conn.commit()
-        logger.debug("Completed raid background task.")
+                logger.warning("Missing permissions to delete raid post in channel {0}".format(channel.id))
+        else:
+            raid_start_msg = _("Gondor calls for aid! Will you answer the call")
+            if raid.roster:
+                player_msg = " ".join(["<@{0}>".format(slot[0]) for slot in raid.slots if slot[0]])
+                raid_start_msg = " ".join([raid_start_msg, player_msg])
+            raid_start_msg = raid_start_msg + _("? We are forming for the raid now.")
+            try:
+                await channel.send(raid_start_msg, delete_after=self.notify_time * 2)
+            except discord.Forbidden:
+                logger.warning("Missing permissions to send raid notification to channel {0}".format(channel.id))
+
+    @commands.Cog.listener()
+    async def on_raw_message_delete(self, payload):
+        if payload.message_id in self.raids:
+            await self.cleanup_old_raid(payload.message_id, "Raid post has been deleted.")
+            await self.db.commit()
+
+    @commands.Cog.listener()
+    async def on_raw_bulk_message_delete(self, payload):
+        raid_ids = [raid_id for raid_id in payload.message_ids if raid_id in self.raids]
+        for raid_id in raid_ids:
+            await self.cleanup_old_raid(raid_id, "Raid post has been deleted.")
+        if raid_ids:
+            await self.db.commit()
+
+    @commands.Cog.listener()
+    async def on_guild_channel_delete(self, channel):
+        raids = [raid for raid in self.raids.guild_raids(channel.guild.id) if raid.channel_id == channel.id]
+        for raid in raids:
+            await self.cleanup_old_raid(raid.raid_id, "Raid channel has been deleted.")
+        if raids:
+            await self.db.commit()
+
+    @commands.Cog.listener()
+    async def on_guild_remove(self, guild):
+        raids = self.raids.guild_raids(guild.id)
+        for raid in raids:
+            await self.cleanup_old_raid(raid.raid_id, "We have left the raid's guild.")
+        if raids:
+            await self.db.commit()
 
     async def cleanup_old_raid(self, raid_id, message):
         logger.info(message)
-        guild_id = select_one(self.conn, 'Raids', ['guild_id'], ['raid_id'], [raid_id])
-        delete(self.conn, 'Raids', ['raid_id'], [raid_id])
-        delete(self.conn, 'Players', ['raid_id'], [raid_id])
-        delete(self.conn, 'Assignment', ['raid_id'], [raid_id])
-        logger.info("Deleted old raid from database.")
-        await self.calendar_cog.update_calendar(guild_id, new_run=False)
-        try:
-            self.raids.remove(raid_id)
-        except ValueError:
+        raid = self.raids.pop(raid_id)
+        if not raid:
             logger.info("Raid already deleted from memory.")
-
-    @background_task.before_loop
-    async def before_background_task(self):
-        await self.bot.wait_until_ready()
-
-    @background_task.error
-    async def handle_error(self, exception):
-        logger.error("Raid background task failed.")
-        logger.error(exception, exc_info=True)
+            return
+        await raid.delete()
+        await self.bot.fingerprints.forget(raid_id)
+        logger.info("Deleted old raid from database.")
+        self.calendar_cog.update_calendar(raid.guild_id, new_run=False)
 
 
 class RaidView(discord.ui.View):
     def __init__(self, raid_cog):
         super().__init__(timeout=None)
         self.raid_cog = raid_cog
-        self.conn = raid_cog.conn
+        self.db = raid_cog.db
         for emoji in raid_cog.class_emojis:
             self.add_item(EmojiButton(emoji))
 
@@ -501,7 +552,11 @@ class RaidView(discord.ui.View):
             return
         msg = _("Please select the setting to update or delete the raid.\n") \
             + _("(This selection message is ephemeral and will cease to work after 60s without interaction.)")
-        modal = ConfigureModal(self.raid_cog, interaction.message.id)
+        raid = await self.raid_cog.get_raid(interaction.message.id)
+        if raid is None:
+            logger.info("The raid has been deleted during editing.")
+            return
+        modal = ConfigureModal(self.raid_cog, raid)
         await interaction.response.send_modal(modal)
 
     @discord.ui.button(emoji="\u26CF\uFE0F", style=discord.ButtonStyle.blurple, custom_id='raid_view:select')
@@ -510,9 +565,11 @@ class RaidView(discord.ui.View):
             perm_msg = _("You do not have permission to change the raid settings.")
             await interaction.response.send_message(perm_msg, ephemeral=True)
             return
-        raid_id = interaction.message.id
-        available = select(self.conn, 'Players', ['player_id, byname'], ['raid_id', 'unavailable'],
-                           [raid_id, False])
+        raid = await self.raid_cog.get_raid(interaction.message.id)
+        if raid is None:
+            logger.info("The raid has been deleted during editing.")
+            return
+        available = raid.available_players()
         if not available:
             msg = _("There are no players to assign for this raid!")
             await interaction.response.send_message(msg, ephemeral=True)
@@ -520,11 +577,11 @@ class RaidView(discord.ui.View):
         msg = _("Please first select the player. The roster is updated when a class is selected. "
                 "You can select a slot manually or leave it on automatic.\n") \
             + _("(This selection message is ephemeral and will cease to work after 60s without interaction.)")
-        view = SelectView(self.raid_cog, raid_id)
+        view = SelectView(self.raid_cog, raid)
         await interaction.response.send_message(msg, view=view, ephemeral=True)
-        roster = select_one(self.conn, 'Raids', ['roster'], ['raid_id'], [raid_id])
-        if not roster:
-            upsert(self.conn, 'Raids', ['roster'], [True], ['raid_id'], [raid_id])
+        if not raid.roster:
+            await raid.update(['roster'], [True])
+            await self.db.commit()
 
     @discord.ui.button(emoji="\u274C", style=discord.ButtonStyle.red, custom_id='raid_view:cancel')
     async def red_cancel(self, interaction: discord.Interaction, button: discord.ui.Button):
@@ -534,6 +591,18 @@ class RaidView(discord.ui.View):
     async def green_check(self, interaction: discord.Interaction, button: discord.ui.Button):
         await self.sign_up_all(interaction)
 
+    @discord.ui.button(emoji="\U0001F4CB", style=discord.ButtonStyle.grey, custom_id='raid_view:players')
+    async def players(self, interaction: discord.Interaction, button: discord.ui.Button):
+        raid = await self.raid_cog.get_raid(interaction.message.id)
+        if raid is None:
+            logger.info("Player list requested for a raid that is no longer in memory.")
+            return
+        pages = self.raid_cog.build_player_pages(raid)
+        if len(pages) > 1:
+            await interaction.response.send_message(embed=pages[0], view=PageView(pages), ephemeral=True)
+        else:
+            await interaction.response.send_message(embed=pages[0], ephemeral=True)
+
     async def sign_up_class(self, i, class_name):
         try:
             role = discord.utils.get(i.guild.roles, name=class_name)
@@ -546,61 +615,57 @@ class RaidView(discord.ui.View):
             await i.response.send_message(err_msg)
         else:
             await i.response.defer()
-        raid_id = i.message.id
+        raid = await self.raid_cog.get_raid(i.message.id)
+        if raid is None:
+            logger.info("Sign up for a raid that is no longer in memory.")
+            return
         timestamp = int(time.time())
-        byname = self.process_name(i.guild.id, i.user)
-        upsert(self.conn, 'Players', ['byname', 'timestamp', 'unavailable', class_name],
-               [byname, timestamp, False, True], ['player_id', 'raid_id'], [i.user.id, raid_id])
-        self.conn.commit()
-        await self.raid_cog.update_raid_post(raid_id, i.channel)
+        byname = await self.process_name(i.guild.id, i.user)
+        await raid.sign_up(i.user.id, byname, timestamp, [class_name])
+        await self.db.commit()
+        self.raid_cog.update_raid_post(raid.raid_id, i.channel)
 
     async def sign_up_all(self, i):
-        raid_id = i.message.id
         role_names = [role.name for role in i.user.roles if role.name in self.raid_cog.role_names]
         if role_names:
             await i.response.defer()
+            raid = await self.raid_cog.get_raid(i.message.id)
+            if raid is None:
+                logger.info("Sign up for a raid that is no longer in memory.")
+                return
             timestamp = int(time.time())
-            columns = ['byname', 'timestamp', 'unavailable']
-            columns.extend(role_names)
-            byname = self.process_name(i.guild.id, i.user)
-            values = [byname, timestamp, False]
-            values.extend([True] * len(role_names))
-            upsert(self.conn, 'Players', columns, values, ['player_id', 'raid_id'], [i.user.id, raid_id])
-            self.conn.commit()
-            await self.raid_cog.update_raid_post(raid_id, i.channel)
+            byname = await self.process_name(i.guild.id, i.user)
+            await raid.sign_up(i.user.id, byname, timestamp, role_names)
+            await self.db.commit()
+            self.raid_cog.update_raid_post(raid.raid_id, i.channel)
         else:
             err_msg = _("You have not assigned yourself any class roles yet, please sign up with a class first.")
             await i.response.send_message(err_msg, ephemeral=True)
 
     async def sign_up_cancel(self, i):
         await i.response.defer()
-        raid_id = i.message.id
+        raid = await self.raid_cog.get_raid(i.message.id)
+        if raid is None:
+            logger.info("Sign up for a raid that is no longer in memory.")
+            return
         timestamp = int(time.time())
-        assigned_slot = select_one(self.conn, 'Assignment', ['slot_id'], ['player_id', 'raid_id'],
-                                   [i.user.id, raid_id])
+        assigned_slot = raid.player_slot(i.user.id)
         if assigned_slot is not None:
-            class_name = select_one(self.conn, 'Assignment', ['class_name'], ['player_id', 'raid_id'],
-                                    [i.user.id, raid_id])
+            class_name = raid.slots[assigned_slot][2]
             error_msg = _("Dearest raid leader, {0} has cancelled their availability. "
                           "Please note they were assigned to {1} in the raid.").format(i.user.mention, class_name)
             await i.channel.send(error_msg)
-            class_names = ','.join(self.raid_cog.slots_class_names[assigned_slot])
-            assign_columns = ['player_id', 'byname', 'class_name']
-            assign_values = [None, _("<Open>"), class_names]
-            upsert(self.conn, 'Assignment', assign_columns, assign_values, ['raid_id', 'slot_id'],
-                   [raid_id, assigned_slot])
-        r = select_one(self.conn, 'Players', ['byname'], ['player_id', 'raid_id'], [i.user.id, raid_id])
-        if r:
-            delete(self.conn, 'Players', ['player_id', 'raid_id'], [i.user.id, raid_id])
+            await self.raid_cog.clear_slot(raid, assigned_slot)
+        if i.user.id in raid.players:
+            await raid.remove_player(i.user.id)
         else:
-            byname = self.process_name(i.guild.id, i.user)
-            upsert(self.conn, 'Players', ['byname', 'timestamp', 'unavailable'], [byname, timestamp, True],
-                   ['player_id', 'raid_id'], [i.user.id, raid_id])
-        self.conn.commit()
-        await self.raid_cog.update_raid_post(raid_id, i.channel)
-
-    def process_name(self, guild_id, user):
-        role_id = select_one(self.conn, 'Settings', ['priority'], ['guild_id'], [guild_id])
+            byname = await self.process_name(i.guild.id, i.user)
+            await raid.sign_off(i.user.id, byname, timestamp)
+        await self.db.commit()
+        self.raid_cog.update_raid_post(raid.raid_id, i.channel)
+
+    async def process_name(self, guild_id, user):
+        role_id = self.raid_cog.bot.settings.get(guild_id).priority
         if role_id in [role.id for role in user.roles]:
             byname = "\U0001F46A " + user.display_name
         else:
@@ -620,23 +685,40 @@ class EmojiButton(discord.ui.Button):
         await self.view.sign_up_class(interaction, class_name)
 
 
+class PageView(discord.ui.View):
+    def __init__(self, pages):
+        super().__init__(timeout=60)
+        self.pages = pages
+        self.page = 0
+
+    async def show_page(self, interaction, page):
+        self.page = page % len(self.pages)
+        await interaction.response.edit_message(embed=self.pages[self.page], view=self)
+
+    @discord.ui.button(emoji="\u25C0\uFE0F", style=discord.ButtonStyle.grey)
+    async def previous_page(self, interaction: discord.Interaction, button: discord.ui.Button):
+        await self.show_page(interaction, self.page - 1)
+
+    @discord.ui.button(emoji="\u25B6\uFE0F", style=discord.ButtonStyle.grey)
+    async def next_page(self, interaction: discord.Interaction, button: discord.ui.Button):
+        await self.show_page(interaction, self.page + 1)
+
+
 class SelectView(discord.ui.View):
-    def __init__(self, raid_cog, raid_id):
+    def __init__(self, raid_cog, raid):
         super().__init__(timeout=60)
         self.raid_cog = raid_cog
-        self.raid_id = raid_id
-        self.conn = raid_cog.conn
+        self.raid = raid
+        self.raid_id = raid.raid_id
+        self.db = raid_cog.db
 
         self.slot = -1
         self.player = None
 
         self.add_item(SlotSelect(len(raid_cog.slots_class_names)))
-        self.add_item(PlayerSelect(raid_cog.conn, raid_id))
+        self.add_item(PlayerSelect(raid.available_players()))
         self.add_item(ClassSelect(raid_cog.class_emojis))
 
-    async def on_timeout(self):
-        self.conn.commit()
-
 
 class SlotSelect(discord.ui.Select):
     def __init__(self, number_of_slots):
@@ -653,17 +735,16 @@ class SlotSelect(discord.ui.Select):
 
 
 class PlayerSelect(discord.ui.Select):
-    def __init__(self, conn, raid_id):
-        available = select(conn, 'Players', ['player_id, byname'], ['raid_id', 'unavailable'], [raid_id, False])
+    def __init__(self, available):
         if len(available) > 25:
             available = available[:25]  # discord API limit is 25 options
         options = []
         for player in available:
-            options.append(discord.SelectOption(value=player[0], label=player[1]))
+            options.append(discord.SelectOption(value=player.player_id, label=player.byname))
         super().__init__(placeholder=_("Player"), options=options)
 
     async def callback(self, interaction: discord.Interaction):
-        self.view.player = self.values[0]
+        self.view.player = int(self.values[0])
         await interaction.response.defer()
 
 
@@ -676,29 +757,32 @@ class ClassSelect(discord.ui.Select):
         super().__init__(placeholder=_("Class"), options=options)
 
     async def callback(self, interaction: discord.Interaction):
-        raid_id = self.view.raid_id
+        raid = self.view.raid
+        raid_id = raid.raid_id
         if self.view.player is None:
             msg = _("Please select a player first.")
             await interaction.response.send_message(msg, ephemeral=True)
             return
 
         if self.values[0] == 'remove':
-            self.clear_assignment()
+            await self.clear_assignment()
+            await self.view.db.commit()
             await interaction.response.defer()
-            await self.view.raid_cog.update_raid_post(raid_id, interaction.channel)
+            self.view.raid_cog.update_raid_post(raid_id, interaction.channel)
             return
 
-        signup = select_one(self.view.conn, 'Players', [self.values[0], 'byname'], ['player_id', 'raid_id'],
-                            [self.view.player, raid_id])
-        if not signup[0]:
-            msg = _("{0} did not sign up with {1}.").format(signup[1], self.values[0])
+        player = raid.players.get(self.view.player)
+        if player is None:
+            msg = _("Please select a player first.")
+            await interaction.response.send_message(msg, ephemeral=True)
+            return
+        if self.values[0] not in raid.class_names(player.classes):
+            msg = _("{0} did not sign up with {1}.").format(player.byname, self.values[0])
             await interaction.response.send_message(msg, ephemeral=True)
             return
 
         if self.view.slot == -1:
-            search = '%' + self.values[0] + '%'
-            slot_id = select_one(self.view.conn, 'Assignment', ['slot_id'], ['raid_id'], [raid_id], ['player_id'],
-                                 ['class_name'], [search])
+            slot_id = raid.open_slot(self.values[0])
         else:
             slot_id = self.view.slot
         if slot_id is None:
@@ -707,23 +791,16 @@ class ClassSelect(discord.ui.Select):
             await interaction.response.send_message(msg, ephemeral=True)
             return
 
-        self.clear_assignment()
-        assignment_columns = ['player_id', 'byname', 'class_name']
-        assignment_values = [self.view.player, signup[1], self.values[0]]
-        upsert(self.view.conn, 'Assignment', assignment_columns, assignment_values, ['raid_id', 'slot_id'],
-               [raid_id, slot_id])
+        await self.clear_assignment()
+        await raid.assign(slot_id, player.player_id, player.byname, self.values[0])
+        await self.view.db.commit()
         await interaction.response.defer()
-        await self.view.raid_cog.update_raid_post(raid_id, interaction.channel)
+        self.view.raid_cog.update_raid_post(raid_id, interaction.channel)
 
-    def clear_assignment(self):
-        slot = select_one(self.view.conn, 'Assignment', ['slot_id', 'byname'], ['player_id', 'raid_id'],
-                          [self.view.player, self.view.raid_id])
-        if slot is not None:
-            assignment_columns = ['player_id', 'byname', 'class_name']
-            class_names = ','.join(self.view.raid_cog.slots_class_names[slot[0]])
-            assignment_values = [None, _("<Open>"), class_names]
-            upsert(self.view.conn, 'Assignment', assignment_columns, assignment_values, ['raid_id', 'slot_id'],
-                   [self.view.raid_id, slot[0]])
+    async def clear_assignment(self):
+        slot_id = self.view.raid.player_slot(self.view.player)
+        if slot_id is not None:
+            await self.view.raid_cog.clear_slot(self.view.raid, slot_id)
 
 
 #class TierSelect(discord.ui.Select):
@@ -741,8 +818,8 @@ class ClassSelect(discord.ui.Select):
 #    async def callback(self, interaction: discord.Interaction):
 #        tier = self.values[0]
 #        upsert(self.view.conn, 'Raids', ['tier'], [tier], ['raid_id'], [self.view.raid_id])
-#        await self.view.raid_cog.update_raid_post(self.view.raid_id, interaction.channel)
-#        await self.view.calendar_cog.update_calendar(interaction.guild.id, new_run=False)
+#        self.view.raid_cog.update_raid_post(self.view.raid_id, interaction.channel)
+#        self.view.calendar_cog.update_calendar(interaction.guild.id, new_run=False)
 #        try:
 #            self.view.calendar_cog.modify_guild_event(self.view.raid_id)
 #        except requests.HTTPError as e:
@@ -751,21 +828,16 @@ class ClassSelect(discord.ui.Select):
 
 class ConfigureModal(discord.ui.Modal):
 
-    def __init__(self, raid_cog, raid_id):
+    def __init__(self, raid_cog, raid):
         super().__init__(title='Raid Settings')
         self.raid_cog = raid_cog
         self.calendar_cog = raid_cog.bot.get_cog('CalendarCog')
-        self.raid_id = raid_id
-        self.conn = raid_cog.conn
-        try:
-            name, tier, aim, = select_one(self.conn, 'Raids', ['name', 'tier', 'boss'],
-                                            ['raid_id'], [raid_id])
-        except TypeError:
-            logger.info("The raid has been deleted during editing.")
-            return
-        name_field = discord.ui.TextInput(custom_id='name', label='Name', default=name, max_length=256)
-        tier_field = discord.ui.TextInput(custom_id='tier', label='Tier', required=False, default=tier, max_length=8)
-        aim_field = discord.ui.TextInput(custom_id='boss', label='Aim', required=False, default=aim, max_length=1024)
+        self.raid = raid
+        self.raid_id = raid.raid_id
+        self.db = raid_cog.db
+        name_field = discord.ui.TextInput(custom_id='name', label='Name', default=raid.name, max_length=256)
+        tier_field = discord.ui.TextInput(custom_id='tier', label='Tier', required=False, default=raid.tier, max_length=8)
+        aim_field = discord.ui.TextInput(custom_id='boss', label='Aim', required=False, default=raid.boss, max_length=1024)
         time_field = discord.ui.TextInput(custom_id='time', label='Time', required=False, placeholder=_("Leave blank to keep the existing time."), max_length=64)
         delete_field = discord.ui.TextInput(custom_id='delete', label='Delete', required=False, placeholder=_("Type 'delete' here to delete the raid."), max_length=8)
         self.add_item(name_field)
@@ -794,7 +866,7 @@ class ConfigureModal(discord.ui.Modal):
         time_input = raid_values[time_index]
         if time_input:
             try:
-                timestamp = Time().converter(self.raid_cog.bot, interaction.guild_id, interaction.user.id, time_input)
+                timestamp = await Time().converter(self.raid_cog.bot, interaction.guild_id, interaction.user.id, time_input)
             except commands.BadArgument:
                 resp_msg = _("Failed to parse time argument: ") + time_input
                 raid_columns.pop(time_index)
@@ -804,29 +876,34 @@ class ConfigureModal(discord.ui.Modal):
         else:
             raid_columns.pop(time_index)
             raid_values.pop(time_index)
-        # write to database
-        upsert(self.conn, 'Raids', raid_columns, raid_values, ['raid_id'], [self.raid_id])
-        self.conn.commit()
+        # write to memory and database
+        old_time = self.raid.time
+        await self.raid.update(raid_columns, raid_values)
+        if self.raid_id in self.raid_cog.raids and self.raid.time != old_time:
+            self.raid_cog.raids.reindex(self.raid, old_time)
+            self.raid_cog.schedule_raid(self.raid)
+        await self.db.commit()
         # respond
         await interaction.response.send_message(resp_msg, ephemeral=True)
         # Update corresponding discord posts and events
-        await self.raid_cog.update_raid_post(self.raid_id, interaction.channel)
-        await self.calendar_cog.update_calendar(interaction.guild.id, new_run=False)
+        self.raid_cog.update_raid_post(self.raid_id, interaction.channel)
+        self.calendar_cog.update_calendar(interaction.guild.id, new_run=False)
         try:
-            self.calendar_cog.modify_guild_event(self.raid_id)
-        except requests.HTTPError as e:
-            logger.warning(e.response.text)
+            await self.calendar_cog.modify_guild_event(self.raid)
+        except discord.HTTPException as e:
+            logger.warning(e.text)
         self.stop()
 
     async def delete_raid(self, interaction: discord.Interaction):
         await interaction.response.defer()
         # Delete the guild event
         try:
-            self.calendar_cog.delete_guild_event(self.raid_id)
-        except requests.HTTPError as e:
-            logger.warning(e.response.text)
+            await self.calendar_cog.delete_guild_event(self.raid)
+        except discord.HTTPException as e:
+            logger.warning(e.text)
         # remove from memory first
         await self.raid_cog.cleanup_old_raid(self.raid_id, "Raid deleted via button.")
+        await self.db.commit()
         # so deletion doesn't trigger another clean up
         post = interaction.channel.get_partial_message(self.raid_id)
         try:
@@ -0,0 +1,20 @@
+import csv
+import logging
+
+from utils import FuzzyMatcher
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+# Plain python so it can run in worker processes, which import it without discord or gettext.
+
+# Load raid (nick)names
+with open('list-of-raids.csv', 'r') as f:
+    reader = csv.reader(f)
+    raid_lookup = dict(reader)
+raid_matcher = FuzzyMatcher(raid_lookup.values())
+
+
+def match_raid_name(name):
+    """ fuzzy match name against the full raid names, runs in a worker """
+    return raid_matcher.get_match(name)
@@ -0,0 +1,238 @@
+import bisect
+import logging
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+
+class Player:
+    """ a sign up for a raid, with the classes stored as a bitmask over the configured role names
+
+    line caches the player's rendered line in the raid post and is reset whenever the sign up changes.
+    """
+    __slots__ = ('player_id', 'byname', 'timestamp', 'unavailable', 'classes', 'line')
+
+    def __init__(self, player_id, byname, timestamp, unavailable, classes=0):
+        self.player_id = player_id
+        self.byname = byname
+        self.timestamp = timestamp
+        self.unavailable = bool(unavailable)
+        self.classes = classes
+        self.line = None
+
+
+class RaidState:
+    """ in-memory copy of a raid's rows in Raids, Players and Assignment
+
+    Every mutation updates memory first and is then written through to the database, so rendering a raid never has
+    to query. Committing remains up to the caller.
+    """
+
+    raid_columns = ['channel_id', 'guild_id', 'organizer_id', 'event_id', 'name', 'tier', 'boss', 'time', 'roster']
+
+    def __init__(self, db, role_names, raid_id, channel_id, guild_id, organizer_id, event_id, name, tier, boss, time,
+                 roster):
+        self.db = db
+        self.role_names = role_names
+        self.raid_id = raid_id
+        self.channel_id = channel_id
+        self.guild_id = guild_id
+        self.organizer_id = organizer_id
+        self.event_id = event_id
+        self.name = name
+        self.tier = tier
+        self.boss = boss
+        self.time = int(time)
+        self.roster = bool(roster)
+        # Insertion order matches the order in which players first signed up.
+        self.players = {}
+        # Each slot is a list of [player_id, byname, class_name].
+        self.slots = []
+
+    @classmethod
+    async def load_all(cls, db, role_names, guild_filter=None):
+        """ load every raid, or those whose guild passes guild_filter, returns a dict of raid_id: RaidState """
+        raids = {}
+        rows = await db.select('Raids', ['raid_id'] + cls.raid_columns)
+        for row in rows:
+            raid = cls(db, role_names, *row)
+            if guild_filter is None or guild_filter(raid.guild_id):
+                raids[row[0]] = raid
+        rows = await db.select('Players', ['raid_id', 'player_id', 'byname', 'timestamp', 'unavailable'] +
+                               list(role_names))
+        for row in rows:
+            try:
+                raid = raids[row[0]]
+            except KeyError:
+                continue
+            raid.players[row[1]] = Player(row[1], row[2], row[3], row[4], raid.bitmask(row[5:]))
+        rows = await db.select_order('Assignment', ['raid_id', 'slot_id', 'player_id', 'byname', 'class_name'],
+                                     'slot_id')
+        for row in rows:
+            try:
+                raid = raids[row[0]]
+            except KeyError:
+                continue
+            raid.slots.append([row[2], row[3], row[4]])
+        return raids
+
+    @classmethod
+    def from_snapshot(cls, db, role_names, snapshot):
+        """ build the state of a raid from a database.RaidSnapshot """
+        raid = cls(db, role_names, *snapshot.raid)
+        for row in snapshot.players:
+            raid.players[row[0]] = Player(row[0], row[1], row[2], row[3], raid.bitmask(row[4:]))
+        for row in snapshot.assignments:
+            raid.slots.append([row[1], row[2], row[3]])
+        return raid
+
+    @classmethod
+    async def load(cls, db, role_names, raid_id):
+        """ load a single raid from the database, returns None if it does not exist """
+        snapshot = await db.load_raid_snapshot(raid_id)
+        if snapshot is None:
+            return None
+        return cls.from_snapshot(db, role_names, snapshot)
+
+    def bitmask(self, flags):
+        """ convert a sequence of booleans in role name order to a bitmask """
+        mask = 0
+        for i, flag in enumerate(flags):
+            if flag:
+                mask |= 1 << i
+        return mask
+
+    def class_names(self, mask):
+        return [name for i, name in enumerate(self.role_names) if mask & (1 << i)]
+
+    def available_players(self):
+        return [player for player in self.players.values() if not player.unavailable]
+
+    def unavailable_players(self):
+        return [player for player in self.players.values() if player.unavailable]
+
+    def player_slot(self, player_id):
+        """ return the slot the player is assigned to, or None """
+        for slot_id, slot in enumerate(self.slots):
+            if slot[0] == player_id:
+                return slot_id
+        return None
+
+    def open_slot(self, class_name):
+        """ return the first unassigned slot which accepts class_name, or None """
+        for slot_id, slot in enumerate(self.slots):
+            if slot[0] is None and class_name in slot[2]:
+                return slot_id
+        return None
+
+    async def insert(self):
+        values = [getattr(self, column) for column in self.raid_columns]
+        await self.db.upsert('Raids', self.raid_columns, values, ['raid_id'], [self.raid_id])
+
+    async def update(self, columns, values):
+        """ update raid metadata, columns must be attributes listed in raid_columns """
+        for column, value in zip(columns, values):
+            setattr(self, column, value)
+        await self.db.upsert('Raids', columns, values, ['raid_id'], [self.raid_id])
+
+    async def sign_up(self, player_id, byname, timestamp, class_names):
+        """ mark the player available with class_names in addition to any classes they already signed up with """
+        player = self.players.get(player_id)
+        if player is None:
+            player = Player(player_id, byname, timestamp, False)
+            self.players[player_id] = player
+        player.byname = byname
+        player.timestamp = timestamp
+        player.unavailable = False
+        player.classes |= self.bitmask([name in class_names for name in self.role_names])
+        player.line = None
+        columns = ['byname', 'timestamp', 'unavailable']
+        columns.extend(class_names)
+        values = [byname, timestamp, False]
+        values.extend([True] * len(class_names))
+        await self.db.upsert('Players', columns, values, ['player_id', 'raid_id'], [player_id, self.raid_id])
+
+    async def sign_off(self, player_id, byname, timestamp):
+        """ mark the player unavailable """
+        player = self.players.get(player_id)
+        if player is None:
+            player = Player(player_id, byname, timestamp, True)
+            self.players[player_id] = player
+        player.byname = byname
+        player.timestamp = timestamp
+        player.unavailable = True
+        player.line = None
+        await self.db.upsert('Players', ['byname', 'timestamp', 'unavailable'], [byname, timestamp, True],
+                             ['player_id', 'raid_id'], [player_id, self.raid_id])
+
+    async def remove_player(self, player_id):
+        self.players.pop(player_id, None)
+        await self.db.delete('Players', ['player_id', 'raid_id'], [player_id, self.raid_id])
+
+    async def assign(self, slot_id, player_id, byname, class_name):
+        while len(self.slots) <= slot_id:
+            self.slots.append([None, None, ""])
+        self.slots[slot_id] = [player_id, byname, class_name]
+        await self.db.upsert('Assignment', ['player_id', 'byname', 'class_name'], [player_id, byname, class_name],
+                             ['raid_id', 'slot_id'], [self.raid_id, slot_id])
+
+    async def delete(self):
+        await self.db.delete('Raids', ['raid_id'], [self.raid_id])
+        await self.db.delete('Players', ['raid_id'], [self.raid_id])
+        await self.db.delete('Assignment', ['raid_id'], [self.raid_id])
+
+
+class RaidRegistry:
+    """ active raids by raid_id, indexed by guild
+
+    Each guild's index is a list of (time, raid_id) kept sorted with bisect. Call reindex after changing a raid's time.
+    """
+
+    def __init__(self, raids=()):
+        self.raids = {}
+        self.by_guild = {}
+        for raid in raids:
+            self.add(raid)
+
+    def __len__(self):
+        return len(self.raids)
+
+    def __contains__(self, raid_id):
+        return raid_id in self.raids
+
+    def get(self, raid_id):
+        return self.raids.get(raid_id)
+
+    def values(self):
+        return self.raids.values()
+
+    def add(self, raid):
+        self.raids[raid.raid_id] = raid
+        key = (raid.time, raid.raid_id)
+        bisect.insort(self.by_guild.setdefault(raid.guild_id, []), key)
+
+    def pop(self, raid_id):
+        """ remove and return the raid, or None if it is not registered """
+        raid = self.raids.pop(raid_id, None)
+        if raid:
+            self.unindex(raid, raid.time)
+        return raid
+
+    def unindex(self, raid, time):
+        key = (time, raid.raid_id)
+        guild_index = self.by_guild[raid.guild_id]
+        guild_index.pop(bisect.bisect_left(guild_index, key))
+        if not guild_index:
+            del self.by_guild[raid.guild_id]
+
+    def reindex(self, raid, old_time):
+        """ move the raid to its new position after its time changed from old_time """
+        if raid.time == old_time:
+            return
+        self.unindex(raid, old_time)
+        key = (raid.time, raid.raid_id)
+        bisect.insort(self.by_guild.setdefault(raid.guild_id, []), key)
+
+    def guild_raids(self, guild_id):
+        """ return the guild's raids ordered by time """
+        return [self.raids[raid_id] for time, raid_id in self.by_guild.get(guild_id, [])]
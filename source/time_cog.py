@@ -1,4 +1,4 @@
-import dateparser
+import asyncio
 import datetime
 import discord
 import logging
@@ -6,24 +6,20 @@ import pytz
 
 from discord import app_commands
 from discord.ext import commands
+from time import perf_counter
 from typing import Optional
 
-from database import create_table, select_one, upsert
-from utils import get_partial_matches
+from time_parser import common_timezones, match_time_zones, parse_time, warm_up
+from utils import LRUCache
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 
-with open('common_timezones.txt', 'r') as f:
-    common_timezones = f.read().splitlines()
-
-with open('timezones.txt', 'r') as f:
-    timezones = f.read().splitlines()
 
 async def time_zone_autocomplete(interaction: discord.Interaction, current: str):
     tz_suggestions = common_timezones
     if current:
-        query = get_partial_matches(current, timezones)
+        query = await interaction.client.workers.run('time zone autocomplete', match_time_zones, current)
         if query:
             tz_suggestions = query
     return [
@@ -39,58 +35,88 @@ class TimeGroup(app_commands.Group):
 
 
 class Time(commands.Converter):
+    # Parsed timestamps keyed on (argument, time zone, server, minute of the relative base).
+    memo = LRUCache(1024)
+
     async def convert(self, ctx, argument):
-        return self.converter(ctx.bot, ctx.guild.id, ctx.author.id, argument)
+        return await self.converter(ctx.bot, ctx.guild.id, ctx.author.id, argument)
 
     @staticmethod
-    def converter(bot, guild_id, author_id, argument):
+    async def converter(bot, guild_id, author_id, argument):
         time_cog = bot.get_cog('TimeCog')
-        parse_settings = {'PREFER_DATES_FROM': 'future'}
         argument_lower = argument.lower()
         server = _("server")
-        if server in argument_lower:
+        is_server = server in argument_lower
+        if is_server:
             # Strip off server (time) and return as server time
             argument = argument_lower.partition(server)[0]
-            parse_settings['TIMEZONE'] = time_cog.get_server_timezone(guild_id)
-            parse_settings['RETURN_AS_TIMEZONE_AWARE'] = True
-        time = dateparser.parse(argument, settings=parse_settings)
-        if time is None:
-            raise commands.BadArgument(_("Failed to parse time argument: ") + argument)
-        if time.tzinfo is None:
-            user_timezone = time_cog.get_user_timezone(author_id, guild_id)
-            parse_settings['TIMEZONE'] = user_timezone
-            parse_settings['RETURN_AS_TIMEZONE_AWARE'] = True
-            tz = pytz.timezone(parse_settings['TIMEZONE'])
+            tz_name = await time_cog.get_server_timezone(guild_id)
         else:
-            tz = time.tzinfo
-        # Parse again with time zone specific relative base as workaround for upstream issue
-        # Upstream always checks if the time has passed in UTC, not in the specified timezone
-        parse_settings['RELATIVE_BASE'] = datetime.datetime.now(tz=tz).replace(tzinfo=None)
-        time = dateparser.parse(argument, settings=parse_settings)
+            tz_name = await time_cog.get_user_timezone(author_id, guild_id)
+
+        now = datetime.datetime.now(tz=datetime.timezone.utc)
+        # Within a minute the result only depends on the relative base through comparisons with whole minutes,
+        # except exactly on the minute.
+        memoize = bool(now.second or now.microsecond)
+        key = (' '.join(argument_lower.split()), tz_name, is_server, int(now.timestamp()) // 60)
+        timestamp = Time.memo.get(key) if memoize else None
+        if timestamp is None:
+            time = await bot.workers.run('time conversion', parse_time, argument, tz_name, is_server, now,
+                                         time_cog.languages)
+            if time is None:
+                raise commands.BadArgument(_("Failed to parse time argument: ") + argument)
+            timestamp = int(time.timestamp())
+            # Results carrying the base's seconds, like "now" or "in 2 hours", cannot be reused.
+            if memoize and not (time.second or time.microsecond):
+                Time.memo.put(key, timestamp)
 
-        timestamp = int(time.timestamp())
         # Avoid scheduling event in the past
         if "now" in argument_lower:
             return timestamp+5
         return timestamp
 
 
+
 class TimeCog(commands.Cog):
     def __init__(self, bot):
         self.bot = bot
-        self.conn = bot.conn
-        create_table(self.bot.conn, 'timezone')
-
-    def get_user_timezone(self, user_id, guild_id):
-        conn = self.bot.conn
-        result = select_one(conn, 'Timezone', ['timezone'], ['player_id'], [user_id])
+        self.db = bot.db
+        # Keep English next to the configured language, the fast path and most users' input are English.
+        if bot.language and bot.language != 'en':
+            self.languages = [bot.language, 'en']
+        elif bot.language:
+            self.languages = ['en']
+        else:
+            self.languages = None
+        # player_id: time zone name or None, mirroring the database. Users can change their time zone in a guild run by
+        # another process, so only cache when this process runs every shard.
+        self.user_timezones = LRUCache(4096 if bot.shard_ids is None else 0)
+
+    async def cog_load(self):
+        start = perf_counter()
+        loop = asyncio.get_running_loop()
+        tz_names = common_timezones + [self.bot.server_tz]
+        try:
+            await loop.run_in_executor(None, warm_up, self.languages, tz_names)
+        except ValueError:
+            logger.warning("Language '{0}' is not supported for parsing times.".format(self.bot.language))
+            self.languages = None
+            await loop.run_in_executor(None, warm_up, self.languages, tz_names)
+        logger.info("Warmed up time parsing in {0:.2f} s.".format(perf_counter() - start))
+        # Worker processes warm up the same way, threads share this process's parser.
+        self.bot.workers.start(warm_up, (self.languages, tz_names))
+
+    async def get_user_timezone(self, user_id, guild_id):
+        result = self.user_timezones.get(user_id, False)
+        if result is False:
+            result = await self.db.select_one('Timezone', ['timezone'], ['player_id'], [user_id])
+            self.user_timezones.put(user_id, result)
         if result is None:
-            result = self.get_server_timezone(guild_id)
+            result = await self.get_server_timezone(guild_id)
         return result
 
-    def get_server_timezone(self, guild_id):
-        conn = self.bot.conn
-        result = select_one(conn, 'Settings', ['server'], ['guild_id'], [guild_id])
+    async def get_server_timezone(self, guild_id):
+        result = self.bot.settings.get(guild_id).server
         if result is None:
             result = self.bot.server_tz
         return result
@@ -98,7 +124,7 @@ class TimeCog(commands.Cog):
     @app_commands.command(name=_("server_time"), description=_("Shows the current server time."))
     @app_commands.guild_only()
     async def server_time_respond(self, interaction: discord.Interaction):
-        tz_str = self.get_server_timezone(interaction.guild_id)
+        tz_str = await self.get_server_timezone(interaction.guild_id)
         server_tz = pytz.timezone(tz_str)
         server_time = datetime.datetime.now(tz=server_tz)
 
@@ -124,8 +150,9 @@ class TimeCog(commands.Cog):
         else:
             tz = None
             content = _("Deleted your time zone data.")
-        res = upsert(self.conn, 'Timezone', ['timezone'], [tz], ['player_id'], [interaction.user.id])
-        self.conn.commit()
+        res = await self.db.upsert('Timezone', ['timezone'], [tz], ['player_id'], [interaction.user.id])
+        await self.db.commit()
+        self.user_timezones.put(interaction.user.id, tz)
         await interaction.response.send_message(content, ephemeral=True)
 
     @group.command(name=_("server"), description=_("Set the time zone for this discord server."))
@@ -147,8 +174,8 @@ class TimeCog(commands.Cog):
         else:
             tz = None
             content = _("Deleted server time zone data.")
-        res = upsert(self.conn, 'Settings', ['server'], [tz], ['guild_id'], [interaction.guild_id])
-        self.conn.commit()
+        res = await self.bot.settings.update(interaction.guild_id, ['server'], [tz])
+        await self.db.commit()
         await interaction.response.send_message(content, ephemeral=True)
 
 
@@ -0,0 +1,174 @@
+import datetime
+import dateparser
+import logging
+import pytz
+import re
+
+from dateparser.date import DateDataParser
+
+from utils import PartialMatcher
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+# Everything here is plain python so it can run in worker processes, which import it without discord or gettext.
+
+with open('common_timezones.txt', 'r') as f:
+    common_timezones = f.read().splitlines()
+
+with open('timezones.txt', 'r') as f:
+    timezones = f.read().splitlines()
+
+timezone_matcher = PartialMatcher(timezones)
+# The parser for naive first parses in this process, set by warm_up.
+date_parser = None
+
+
+def match_time_zones(current):
+    """ time zone names matching current, runs in a worker """
+    return timezone_matcher.get_partial_matches(current)
+
+
+weekdays = ['monday', 'tuesday', 'wednesday', 'thursday', 'friday', 'saturday', 'sunday']
+months = ['january', 'february', 'march', 'april', 'may', 'june', 'july', 'august', 'september', 'october',
+          'november', 'december']
+time_pattern = re.compile(r'(?:^|(?<= ))(?:(\d{1,2})(?::(\d{2}))? ?([ap]m)|(\d{1,2}):(\d{2}))(?=$| )')
+date_pattern = re.compile(r'(\d{1,2}) ([a-z]+)|([a-z]+) (\d{1,2})')
+
+
+def lookup_name(word, names):
+    """ return the index of a full or three letter english name, or None """
+    for i, name in enumerate(names):
+        if word == name or word == name[:3]:
+            return i
+    return None
+
+
+def fast_parse(argument, relative_base, tz):
+    """ parse the most common time arguments without dateparser
+
+    Handles a time ("8pm", "8:30 pm", "20:00") optionally preceded or followed by a weekday or a day and month
+    ("26 july", "jul 26"), as well as a lone weekday or day and month. The result is a naive datetime
+    matching what dateparser returns with PREFER_DATES_FROM future and relative_base, or None if the argument is not
+    one of these forms and dateparser has to handle it.
+    """
+    argument = ' '.join(argument.lower().split())
+    match = time_pattern.search(argument)
+    if match:
+        if match.start() == 0:
+            day_part = argument[match.end():].strip()
+        elif match.end() == len(argument):
+            day_part = argument[:match.start()].strip()
+        else:
+            return None
+        hour, minute, meridiem, hour24, minute24 = match.groups()
+        if meridiem:
+            hour = int(hour)
+            minute = int(minute or 0)
+            if not 1 <= hour <= 12:
+                return None
+            hour = hour % 12 + (12 if meridiem == 'pm' else 0)
+        else:
+            hour = int(hour24)
+            minute = int(minute24)
+            if hour > 23:
+                return None
+        if minute > 59:
+            return None
+    else:
+        day_part = argument
+        hour = minute = 0
+    time = relative_base.replace(hour=hour, minute=minute, second=0, microsecond=0)
+
+    if not day_part:
+        # dateparser compares the time converted to UTC with the local relative base, keep that quirk.
+        try:
+            offset = tz.utcoffset(time)
+        except pytz.NonExistentTimeError:
+            offset = datetime.timedelta(0)
+        except pytz.AmbiguousTimeError:
+            return None
+        if relative_base > time - offset:
+            time += datetime.timedelta(days=1)
+            if time.day == 1:
+                # dateparser does not roll over into the next month here, leave that case to it.
+                return None
+        return time
+
+    weekday = lookup_name(day_part, weekdays)
+    if weekday is not None:
+        days = (weekday - time.weekday()) % 7 or 7
+        return time + datetime.timedelta(days=days)
+
+    match = date_pattern.fullmatch(day_part)
+    if not match:
+        return None
+    day, month_name, month_name_first, day_last = match.groups()
+    month = lookup_name(month_name or month_name_first, months)
+    if month is None:
+        return None
+    try:
+        time = time.replace(month=month + 1, day=int(day or day_last))
+        if not relative_base < time:
+            time = time.replace(year=time.year + 1)
+    except ValueError:
+        return None
+    return time
+
+
+def warm_up(languages, tz_names):
+    """ load dateparser's language data and compile the time zones, returns a parser for naive first parses
+
+    Also initialises worker processes, which keep the parser in date_parser.
+    """
+    global date_parser
+    for tz_name in tz_names:
+        try:
+            pytz.timezone(tz_name)
+        except pytz.UnknownTimeZoneError:
+            logger.warning("Unknown time zone {0}.".format(tz_name))
+    parser = DateDataParser(languages=languages, settings={'PREFER_DATES_FROM': 'future'})
+    parse_settings = {'PREFER_DATES_FROM': 'future', 'TIMEZONE': 'UTC', 'RETURN_AS_TIMEZONE_AWARE': True,
+                      'RELATIVE_BASE': datetime.datetime.now()}
+    for argument in ['friday 8pm', '26 july 1pm', '20:00', 'in 2 hours', '8pm cet']:
+        parser.get_date_data(argument)
+        dateparser.parse(argument, languages=languages, settings=parse_settings)
+    date_parser = parser
+    return parser
+
+
+def parse(argument, tz_name, is_server, now, languages=None, parser=None):
+    """ parse argument relative to the aware datetime now, returns an aware datetime or None
+
+    parser is used for the first parse outside of server time and must have been created with languages.
+    """
+    tz = pytz.timezone(tz_name)
+    time = fast_parse(argument, now.astimezone(tz).replace(tzinfo=None), tz)
+    if time is not None:
+        return tz.localize(time)
+
+    parse_settings = {'PREFER_DATES_FROM': 'future'}
+    if is_server:
+        parse_settings['TIMEZONE'] = tz_name
+        parse_settings['RETURN_AS_TIMEZONE_AWARE'] = True
+        time = dateparser.parse(argument, languages=languages, settings=parse_settings)
+    elif parser:
+        time = parser.get_date_data(argument)['date_obj']
+    else:
+        time = dateparser.parse(argument, languages=languages, settings=parse_settings)
+    if time is None:
+        return None
+    if time.tzinfo is None:
+        parse_settings['TIMEZONE'] = tz_name
+        parse_settings['RETURN_AS_TIMEZONE_AWARE'] = True
+    else:
+        tz = time.tzinfo
+    # Parse again with time zone specific relative base as workaround for upstream issue
+    # Upstream always checks if the time has passed in UTC, not in the specified timezone
+    parse_settings['RELATIVE_BASE'] = now.astimezone(tz).replace(tzinfo=None)
+    return dateparser.parse(argument, languages=languages, settings=parse_settings)
+
+
+def parse_time(argument, tz_name, is_server, now, languages):
+    """ parse with this process's parser, runs in a worker """
+    return parse(argument, tz_name, is_server, now, languages, date_parser)
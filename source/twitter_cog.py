@@ -7,8 +7,6 @@ from discord import app_commands
 from discord.ext import commands
 from discord.ext import tasks
 
-from database import create_table, select, select_one, upsert
-
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 
@@ -17,13 +15,14 @@ class TwitterCog(commands.GroupCog, name=_("twitter"), description=_("Manage twi
 
     def __init__(self, bot):
         self.bot = bot
-        self.conn = bot.conn
+        self.db = bot.db
         self.twitter_id = bot.twitter_id
-        create_table(self.conn, 'twitter')
         super().__init__()
 
     async def cog_load(self):
-        self.twitter_task.start()
+        # When sharded only the process running shard 0 polls twitter, it posts to every guild.
+        if self.bot.is_primary:
+            self.twitter_task.start()
 
     async def cog_unload(self):
         self.twitter_task.cancel()
@@ -53,29 +52,43 @@ class TwitterCog(commands.GroupCog, name=_("twitter"), description=_("Manage twi
         if count:
             for i in range(count-1, -1, -1):
                 tweet_id = json_response['data'][i]['id']
-                upsert(self.conn, 'Twitter', ['user_id', 'tweet_id'], [self.twitter_id, tweet_id])
+                await self.db.upsert('Twitter', ['user_id', 'tweet_id'], [self.twitter_id, tweet_id])
+                await self.db.commit()
                 await self.post_tweet_to_servers(tweet_id)
-            self.conn.commit()
 
     async def post_tweet_to_servers(self, tweet_id):
         url = "https://twitter.com/lotro/status/{0}".format(tweet_id)
-        res = select(self.conn, 'Settings', ['guild_id', 'twitter'])
+        if self.bot.shard_ids is None:
+            res = [(settings.guild_id, settings.twitter) for settings in self.bot.settings.values()]
+        else:
+            # Guilds on other processes' shards are not in the settings cache.
+            res = await self.db.select('Settings', ['guild_id', 'twitter'])
         for row in res:
             if row[1]:
                 await self.post_tweet(*row, url)
 
     async def post_tweet(self, guild_id, chn_id, url):
-        chn = self.bot.get_channel(chn_id)
+        if self.bot.owns_guild(guild_id):
+            chn = self.bot.get_channel(chn_id)
+        else:
+            # The channel is cached by another process, post through the API without it.
+            chn = self.bot.get_partial_messageable(chn_id, guild_id=guild_id)
         if chn:
             try:
                 await chn.send(url)
             except discord.Forbidden:
                 logger.warning("Missing write access to Twitter channel for guild {0}.".format(guild_id))
-                upsert(self.conn, 'Settings', ['twitter'], [None], ['guild_id'], [guild_id])
+                await self.bot.settings.update(guild_id, ['twitter'], [None])
+                await self.db.commit()
+            except discord.NotFound:
+                logger.warning("Twitter channel not found for guild {0}.".format(guild_id))
+                await self.bot.settings.update(guild_id, ['twitter'], [None])
+                await self.db.commit()
 
         else:
             logger.warning("Twitter channel not found for guild {0}.".format(guild_id))
-            upsert(self.conn, 'Settings', ['twitter'], [None], ['guild_id'], [guild_id])
+            await self.bot.settings.update(guild_id, ['twitter'], [None])
+            await self.db.commit()
 
     @app_commands.guild_only()
     @app_commands.command(name=_("on"), description=_("Turn on tweets in this channel."))
@@ -89,9 +102,9 @@ class TwitterCog(commands.GroupCog, name=_("twitter"), description=_("Manage twi
         if not (perms.send_messages and perms.embed_links):
             await interaction.response.send_message(_("Missing permissions to access this channel."))
             return
-        upsert(self.conn, 'Settings', ['twitter'], [channel.id], ['guild_id'], [guild.id])
+        await self.bot.settings.update(guild.id, ['twitter'], [channel.id])
+        await self.db.commit()
         await interaction.response.send_message(_("@lotro tweets will be posted to this channel."))
-        self.conn.commit()
 
     @app_commands.guild_only()
     @app_commands.command(name=_("off"), description=_("Turn off tweets in this channel."))
@@ -99,13 +112,13 @@ class TwitterCog(commands.GroupCog, name=_("twitter"), description=_("Manage twi
         if not interaction.user.guild_permissions.administrator:
             await interaction.response.send_message(_("You must be an admin to turn off tweets."), ephemeral=True)
             return
-        upsert(self.conn, 'Settings', ['twitter'], [None], ['guild_id'], [interaction.guild_id])
+        await self.bot.settings.update(interaction.guild_id, ['twitter'], [None])
+        await self.db.commit()
         await interaction.response.send_message(_("Tweets will no longer be posted to this channel."))
-        self.conn.commit()
 
     @tasks.loop(seconds=300)
     async def twitter_task(self):
-        last_tweet_id = select_one(self.conn, 'Twitter', ['tweet_id'], ['user_id'], [self.twitter_id])
+        last_tweet_id = await self.db.select_one('Twitter', ['tweet_id'], ['user_id'], [self.twitter_id])
         await self.get_new_tweets(self.twitter_id, last_tweet_id)
         logger.debug("Completed twitter background task.")
 
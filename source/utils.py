@@ -1,7 +1,23 @@
+import asyncio
+import bisect
+import heapq
+import itertools
+import logging
+import multiprocessing
+import threading
+import time
+
+from collections import OrderedDict
+from concurrent.futures import BrokenExecutor, ProcessPoolExecutor, ThreadPoolExecutor
+from rapidfuzz import fuzz as rfuzz
+from rapidfuzz import process as rprocess
 from thefuzz import fuzz
 from thefuzz import process
 from thefuzz import utils
 
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
 
 def chunks(lst, n):
     """Yield successive n-sized chunks from lst."""
@@ -20,9 +36,9 @@ def fp_ratio(s1, s2, force_ascii=True, full_process=True):
         p1 = s1
         p2 = s2
 
-    if not utils.validate_string(p1):
+    if not p1:
         return 0
-    if not utils.validate_string(p2):
+    if not p2:
         return 0
 
     # should we look at partials?
@@ -38,9 +54,9 @@ def fp_ratio(s1, s2, force_ascii=True, full_process=True):
 
     if try_partial:
         partial = fuzz.partial_ratio(p1, p2) * partial_scale
-        return utils.intr(max(base, partial))
+        return int(round(max(base, partial)))
     else:
-        return utils.intr(base)
+        return int(round(base))
 
 
 def get_match(word: str, word_list: list, score_cutoff: int = 80):
@@ -67,3 +83,308 @@ def get_partial_matches(word: str, word_list: list, score_cutoff: int = 75, limi
     if result:
         return [match[0] for match in result]
     return result
+
+
+class FuzzyMatcher:
+    """Finds the best match for a word in a fixed word list like get_match.
+
+    The word list is processed once and each query is scored against all of it in bulk by rapidfuzz, with the same
+    scores fp_ratio gives.
+    """
+
+    def __init__(self, word_list):
+        self.word_list = list(word_list)
+        self.processed = [self.process(word) for word in self.word_list]
+
+    @staticmethod
+    def process(word):
+        # get_match processes with full_process before fp_ratio processes again forcing ascii.
+        return utils.full_process(utils.full_process(word), force_ascii=True)
+
+    def scores(self, word):
+        """Return fp_ratio of word against every entry of the word list."""
+        p1 = self.process(word)
+        scores = [0] * len(self.processed)
+        if not p1:
+            return scores
+        partials = {}
+        for choice, score, i in rprocess.extract(p1, self.processed, scorer=rfuzz.ratio, processor=None, limit=None):
+            if not choice:
+                continue
+            scores[i] = int(round(score))
+            # if strings are similar length, don't use partials
+            if float(max(len(p1), len(choice))) / min(len(p1), len(choice)) >= 1.5:
+                partials[i] = choice
+        for choice, score, i in rprocess.extract(p1, partials, scorer=rfuzz.partial_ratio, processor=None,
+                                                 limit=None):
+            scores[i] = max(scores[i], int(round(score)) * .9)
+        return [int(round(score)) for score in scores]
+
+    def get_match(self, word: str, score_cutoff: int = 80):
+        """Returns a tuple of (MATCH, SCORE) like get_match"""
+        best = None
+        for i, score in enumerate(self.scores(word)):
+            if score >= score_cutoff and (best is None or score > best[1]):
+                best = (self.word_list[i], score)
+        if not best:
+            return None, None
+        return best
+
+
+class LRUCache:
+    """A dict bounded to maxsize entries, evicting the least recently used one first.
+
+    Safe to share with worker threads.
+    """
+
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self.data = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.data)
+
+    def __contains__(self, key):
+        return key in self.data
+
+    def get(self, key, default=None):
+        with self.lock:
+            try:
+                value = self.data[key]
+            except KeyError:
+                self.misses += 1
+                return default
+            self.data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        with self.lock:
+            self.data[key] = value
+            self.data.move_to_end(key)
+            if len(self.data) > self.maxsize:
+                self.data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self.lock:
+            return self.data.pop(key, default)
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+
+
+class PartialMatcher:
+    """Finds partial matches in a fixed word list like get_partial_matches.
+
+    The word list is processed once and each query is scored against all of it in bulk by rapidfuzz, which is what
+    get_partial_matches does after processing every word again. Results are cached per query.
+    """
+
+    def __init__(self, word_list, cache_size=1024):
+        self.word_list = list(word_list)
+        self.processed = [utils.full_process(word) for word in self.word_list]
+        self.cache = LRUCache(cache_size)
+
+    def get_partial_matches(self, word: str, score_cutoff: int = 75, limit: int = 25):
+        query = utils.full_process(word)
+        key = (query, score_cutoff, limit)
+        result = self.cache.get(key)
+        if result is None:
+            matches = rprocess.extract(query, self.processed, scorer=rfuzz.partial_ratio, processor=None,
+                                       score_cutoff=score_cutoff, limit=limit)
+            result = [self.word_list[i] for choice, score, i in matches]
+            self.cache.put(key, result)
+        return result
+
+
+class Coalescer:
+    """Coalesces repeated requests per key into as few callback runs as possible.
+
+    The first request for a key runs callback(key, *args) straight away. Requests arriving while it runs, or within
+    delay seconds after, are merged into a single follow-up run with the most recent args.
+    """
+
+    def __init__(self, callback, delay):
+        self.callback = callback
+        self.delay = delay
+        self.pending = {}
+        self.tasks = {}
+        self.requests = 0
+        self.runs = 0
+
+    @property
+    def saved(self):
+        """Number of requests that did not need a run of their own."""
+        return self.requests - self.runs - len(self.pending)
+
+    def schedule(self, key, *args):
+        self.requests += 1
+        self.pending[key] = args
+        if key not in self.tasks:
+            self.tasks[key] = asyncio.create_task(self.run(key))
+
+    async def run(self, key):
+        try:
+            while key in self.pending:
+                args = self.pending.pop(key)
+                self.runs += 1
+                try:
+                    await self.callback(key, *args)
+                except Exception as e:
+                    logger.exception(e)
+                await asyncio.sleep(self.delay)
+        finally:
+            del self.tasks[key]
+
+    def cancel(self):
+        for task in self.tasks.values():
+            task.cancel()
+
+
+class Scheduler:
+    """Calls callback(*item) when the deadline (a unix timestamp) of each added item arrives.
+
+    Items are kept in a heap and the loop sleeps until the earliest deadline, waking up early when an earlier one is
+    added. Items are never removed; the callback should ignore any that have become stale.
+    """
+
+    def __init__(self, callback):
+        self.callback = callback
+        self.heap = []
+        self.counter = itertools.count()
+        self.wakeup = asyncio.Event()
+        self.task = None
+
+    def start(self):
+        self.task = asyncio.create_task(self.run())
+
+    def cancel(self):
+        if self.task:
+            self.task.cancel()
+
+    def add(self, deadline, *item):
+        heapq.heappush(self.heap, (deadline, next(self.counter), item))
+        if self.heap[0][0] == deadline:
+            self.wakeup.set()
+
+    async def run(self):
+        while True:
+            while self.heap and self.heap[0][0] <= time.time():
+                deadline, count, item = heapq.heappop(self.heap)
+                try:
+                    await self.callback(*item)
+                except Exception as e:
+                    logger.exception(e)
+            self.wakeup.clear()
+            timeout = self.heap[0][0] - time.time() if self.heap else None
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+
+class LatencyHistogram:
+    """Counts call latencies in buckets bounded by bounds (seconds), the last bucket holds anything slower."""
+
+    bounds = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+
+    def __init__(self):
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def record(self, seconds):
+        self.counts[bisect.bisect_left(self.bounds, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+    def percentile(self, p):
+        """Return the upper bound of the bucket holding the p-th percentile, or the maximum if it is beyond them."""
+        rank = p / 100 * self.count
+        seen = 0
+        for bound, count in zip(self.bounds, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return self.max
+
+    def summary(self):
+        if not self.count:
+            return "no calls"
+        return "{0} calls, mean {1:.1f} ms, p50 < {2:g} ms, p99 < {3:g} ms, max {4:.1f} ms".format(
+            self.count, 1000 * self.total / self.count, 1000 * self.percentile(50), 1000 * self.percentile(99),
+            1000 * self.max)
+
+
+class WorkerPool:
+    """Runs CPU heavy calls off the event loop on a pool of threads or processes, recording their latency by name.
+
+    Worker processes are spawned, so calls for a process pool must be picklable: functions from modules that import
+    without discord or gettext, with picklable arguments. The initializer given to start runs in each worker process,
+    threads share the state of the bot's process. A broken pool is replaced and the call that found it broken is
+    retried on the new one, or on the event loop's default thread pool if that breaks as well.
+    """
+
+    def __init__(self, kind='thread', size=None):
+        if kind not in ('thread', 'process'):
+            raise ValueError("Unknown worker pool kind {0}.".format(kind))
+        self.kind = kind
+        self.size = size
+        self.executor = None
+        self.initializer = None
+        self.initargs = ()
+        self.histograms = {}
+
+    def start(self, initializer=None, initargs=()):
+        """Start the pool, or restart it if a new initializer is given after it started."""
+        if initializer:
+            self.initializer = initializer
+            self.initargs = initargs
+            if self.executor:
+                self.restart()
+                return
+        if self.executor:
+            return
+        if self.kind == 'process':
+            self.executor = ProcessPoolExecutor(max_workers=self.size, mp_context=multiprocessing.get_context('spawn'),
+                                                initializer=self.initializer, initargs=self.initargs)
+        else:
+            self.executor = ThreadPoolExecutor(max_workers=self.size, thread_name_prefix='worker')
+        logger.info("Started {0} worker pool.".format(self.kind))
+
+    def restart(self):
+        self.shutdown()
+        self.executor = None
+        self.start()
+
+    async def run(self, name, func, *args):
+        """Return func(*args) computed by a worker, the latency is recorded under name."""
+        self.start()
+        loop = asyncio.get_running_loop()
+        start = time.perf_counter()
+        executor = self.executor
+        try:
+            return await loop.run_in_executor(executor, func, *args)
+        except BrokenExecutor:
+            logger.error("The {0} worker pool is broken, restarting it to run {1}.".format(self.kind, name))
+            # Concurrent calls all find the same pool broken, only the first one replaces it.
+            if self.executor is executor:
+                self.restart()
+            try:
+                return await loop.run_in_executor(self.executor, func, *args)
+            except BrokenExecutor:
+                logger.error("The new {0} worker pool is broken too, running {1} on the default executor.".format(
+                    self.kind, name))
+                return await loop.run_in_executor(None, func, *args)
+        finally:
+            self.histograms.setdefault(name, LatencyHistogram()).record(time.perf_counter() - start)
+
+    def shutdown(self):
+        if self.executor:
+            self.executor.shutdown(wait=False)
@@ -0,0 +1,10 @@
+import gettext
+import os
+import sys
+
+# The bot runs from source/ and its modules read their data files relative to it.
+source = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'source')
+sys.path.insert(0, source)
+os.chdir(source)
+# The cogs translate their command names at import, the bot installs the real translations in main.
+gettext.NullTranslations().install()
@@ -0,0 +1,79 @@
+import random
+
+import discord
+import pytest
+
+from embed_layout import EMBED_FIELD_LIMIT, EMBED_TOTAL_LIMIT, FIELD_VALUE_LIMIT, fit_fields, pack_lines, paginate, \
+    section_fields
+
+classes = ['Beorning', 'Brawler', 'Burglar', 'Captain', 'Champion', 'Guardian', 'Hunter', 'Loremaster', 'Minstrel',
+           'Runekeeper', 'Warden']
+
+
+def player_line(rng, i):
+    """ a line like the raid cog renders: class emojis followed by a (possibly long, unicode) byname """
+    emojis = "".join("<:{0}:{1}>".format(name, rng.randrange(10**17, 10**18))
+                     for name in rng.sample(classes, rng.randint(1, len(classes))))
+    name = "".join(rng.choice("abcdefghijklmnopqrstuvwxyzÀÉÎÕÜ\U0001F46A ") for n in range(rng.randint(1, 32)))
+    return "{0} {1} {2}\n".format(emojis, i, name)
+
+
+def raid_embed():
+    embed = discord.Embed(title="The Anvil of Winterstith T2c\n<t:1700000000:F>", description="Aim: " + "x" * 200)
+    embed.add_field(name="Selected line up:", value="\n".join("<:Guardian:123456789012345678> Tank" for n in range(6)))
+    embed.add_field(name="\u200B", value="\n".join("<:Minstrel:123456789012345678> Heal" for n in range(6)))
+    return embed
+
+
+def overflow_note(left_out):
+    return "More players", "{0} more fields, use the player list button.".format(len(left_out))
+
+
+def embed_fields(embed):
+    return [(field.name, field.value) for field in embed.fields]
+
+
+def check_limits(embed):
+    assert len(embed) <= EMBED_TOTAL_LIMIT
+    assert len(embed.fields) <= EMBED_FIELD_LIMIT
+    for field in embed.fields:
+        assert len(field.value) <= FIELD_VALUE_LIMIT
+
+
+@pytest.mark.parametrize('seed', range(200))
+def test_pack_lines_keeps_every_line_within_limits(seed):
+    rng = random.Random(seed)
+    lines = [player_line(rng, i) for i in range(rng.randint(0, 300))]
+    block_size = rng.randint(1, 10)
+    values = pack_lines(lines, block_size)
+    assert all(len(value) < FIELD_VALUE_LIMIT for value in values)
+    assert all(value.count("\n") <= block_size for value in values)
+    assert sorted("".join(values).splitlines(keepends=True)) == sorted(lines)
+
+
+@pytest.mark.parametrize('seed', range(200))
+def test_fit_fields_stays_within_limits_and_loses_nothing(seed):
+    rng = random.Random(seed)
+    lines = [player_line(rng, i) for i in range(rng.randint(0, 300))]
+    fields = section_fields("Available:", pack_lines(lines)) + section_fields("Late:", pack_lines(lines[:50]))
+    embed = raid_embed()
+    before = embed_fields(embed)
+    left_out = fit_fields(embed, fields, note=overflow_note)
+    check_limits(embed)
+    added = embed_fields(embed)[len(before):]
+    if left_out:
+        note = added.pop()
+        assert note == overflow_note(left_out)
+    assert added + left_out == fields
+
+
+@pytest.mark.parametrize('seed', range(100))
+def test_paginate_spreads_all_fields_over_valid_pages(seed):
+    rng = random.Random(seed)
+    lines = [player_line(rng, i) for i in range(rng.randint(0, 300))]
+    fields = section_fields("Available:", pack_lines(lines))
+    pages = paginate(raid_embed, fields)
+    for page in pages:
+        check_limits(page)
+    spread = [field for page in pages for field in embed_fields(page)[2:]]
+    assert spread == fields
@@ -0,0 +1,67 @@
+import asyncio
+import logging
+import types
+
+import aiohttp
+import pytest
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+from calendar_cog import CalendarCog, read_events_schedule
+
+fixture = 'benchmarks/fixtures/events_page.html'
+
+
+async def fetch_schedule(content_type, body):
+    async def handler(request):
+        return web.Response(body=body, headers={'Content-Type': content_type})
+
+    app = web.Application()
+    app.router.add_get('/', handler)
+    async with TestServer(app) as server:
+        async with aiohttp.ClientSession() as session:
+            async with session.get(server.make_url('/')) as r:
+                return await read_events_schedule(r)
+
+
+@pytest.mark.parametrize('content_type', ['text/html', 'text/html; charset=utf-8', 'application/octet-stream'])
+def test_schedule_without_charset(content_type):
+    with open(fixture, 'rb') as f:
+        body = f.read()
+    events = asyncio.run(fetch_schedule(content_type, body))
+    assert len(events) == 40
+    assert all(len(event) == 3 for event in events)
+    assert events[0] == ['Skirmish Bonus Marks', '10/4/2026 11:00 PM', '10/5/2026 7:00 AM']
+
+
+def test_schedule_not_found():
+    events = asyncio.run(fetch_schedule('text/html', b'<html><body>Maintenance</body></html>'))
+    assert events is None
+
+
+def test_failed_refresh_is_logged_and_backs_off(caplog):
+    bot = types.SimpleNamespace(db=None, get_cog=lambda name: None, is_primary=True)
+    cog = CalendarCog(bot)
+    calls = []
+
+    async def fetch_events():
+        calls.append(None)
+        raise RuntimeError("Cannot compute fallback encoding of a not yet read body")
+
+    cog.fetch_events = fetch_events
+
+    async def main():
+        first = await cog.get_events()
+        second = await cog.get_events()
+        return first, second
+
+    with caplog.at_level(logging.ERROR, logger='calendar_cog'):
+        assert asyncio.run(main()) == ([], [])
+    assert len(calls) == 1
+    assert "Refreshing the events schedule failed." in caplog.text
+    assert "not yet read body" in caplog.text
+
+    # Once the retry delay has passed a stale request tries again.
+    cog.events_attempted_at -= cog.events_retry_delay + 1
+    asyncio.run(cog.get_events())
+    assert len(calls) == 2
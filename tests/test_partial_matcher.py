@@ -0,0 +1,38 @@
+import random
+import string
+
+import pytest
+
+from utils import PartialMatcher, get_partial_matches
+
+with open('timezones.txt', 'r') as f:
+    timezones = f.read().splitlines()
+
+
+def queries():
+    """ prefixes of every zone as typed during autocomplete, plus a one letter typo of each """
+    rng = random.Random(16)
+    found = {'Abid', 'berln', 'new yrok', 'UTC', 'gmt+1', 'Pacific/', 'a', '/'}
+    for name in timezones:
+        for n in (1, 2, 3, 4, 6, 9):
+            found.add(name[:n])
+        i = rng.randrange(len(name))
+        found.add(name[:i] + rng.choice(string.ascii_lowercase) + name[i + 1:])
+    return sorted(found)
+
+
+@pytest.mark.parametrize('score_cutoff, limit', [(75, 25), (60, 10), (90, 5)])
+def test_matches_get_partial_matches(score_cutoff, limit):
+    matcher = PartialMatcher(timezones)
+    for query in queries():
+        expected = get_partial_matches(query, timezones, score_cutoff, limit)
+        assert matcher.get_partial_matches(query, score_cutoff, limit) == expected, query
+        # and again from the cache
+        assert matcher.get_partial_matches(query, score_cutoff, limit) == expected, query
+
+
+def test_no_trigram_in_common():
+    matcher = PartialMatcher(timezones)
+    matches = matcher.get_partial_matches('Abid')
+    for name in ['Africa/Bissau', 'America/Cambridge_Bay', 'Asia/Bishkek', 'Australia/Adelaide']:
+        assert name in matches
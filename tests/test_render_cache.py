@@ -0,0 +1,73 @@
+import asyncio
+import os
+
+# database reads the classes at import, the render cache does not need them.
+os.environ.setdefault('CLASSES', '["Beorning"]')
+
+from database import AsyncDatabase, create_connection, create_table, select  # noqa: E402
+from embed_layout import RenderCache  # noqa: E402
+
+
+class CountingDatabase(AsyncDatabase):
+    def __init__(self, conn):
+        super().__init__(conn)
+        self.commits = 0
+
+    async def commit(self):
+        self.commits += 1
+        return await super().commit()
+
+
+def stored(path):
+    conn = create_connection(path)
+    try:
+        return dict(select(conn, 'Fingerprints', ['message_id', 'fingerprint']) or [])
+    finally:
+        conn.close()
+
+
+def test_batches_writes(tmp_path, monkeypatch):
+    monkeypatch.setattr(RenderCache, 'flush_delay', 0.2)
+    path = str(tmp_path / 'raid_db')
+    conn = create_connection(path, {'journal_mode': 'WAL', 'busy_timeout': 5000})
+    create_table(conn, 'fingerprint')
+    conn.commit()
+    db = CountingDatabase(create_connection(path, {'journal_mode': 'WAL', 'busy_timeout': 5000}))
+    cache = RenderCache(db)
+
+    async def main():
+        await cache.remember(1, 'a')
+        await asyncio.sleep(0.05)
+        # The first change is written straight away, the rest wait for the next batch.
+        assert stored(path) == {1: 'a'}
+        for message_id in range(2, 50):
+            await cache.remember(message_id, 'b')
+        await cache.remember(1, 'c')
+        await cache.forget(2)
+        assert cache.unchanged(3, 'b')
+        assert len(stored(path)) == 1
+        await asyncio.sleep(0.4)
+        assert db.commits == 2
+        expected = {message_id: 'b' for message_id in range(3, 50)}
+        expected[1] = 'c'
+        assert stored(path) == expected
+        await cache.remember(50, 'd')
+        await cache.remember(51, 'd')
+        await cache.close()
+
+    asyncio.run(main())
+    assert stored(path)[51] == 'd'
+    assert not cache.pending
+    conn.close()
+
+
+def test_without_database():
+    cache = RenderCache()
+
+    async def main():
+        await cache.remember(1, 'a')
+        await cache.forget(1)
+        await cache.close()
+
+    asyncio.run(main())
+    assert not cache.pending and not cache.fingerprints
@@ -0,0 +1,68 @@
+import datetime
+import random
+
+import pytest
+import pytz
+
+import time_parser
+
+zones = ['UTC', 'Europe/Berlin', 'America/New_York', 'America/Los_Angeles', 'America/St_Johns', 'Australia/Sydney',
+         'Pacific/Auckland', 'Asia/Kolkata']
+
+days = ['', 'friday', 'fri', 'monday', 'sun', 'wed', 'thursday', '26 july', 'july 26', 'jul 26', '16 october',
+        'oct 17', '1 jan', '31 dec', '29 feb', '31 apr', '3 march', 'may 5']
+times = ['', '8pm', '8:30 pm', '8 pm', '20:00', '0:30', '12am', '12pm', '23:59', '7:05am', '10PM', '9:00']
+# Forms the fast path must leave to dateparser.
+others = ['now', 'in 2 hours', 'next friday', 'friday 8pm cet', '13pm', '25:00', '8.30pm', 'tues 8pm', 'sept 5 8pm',
+          'tomorrow 8pm', '2026-11-01 1:30', '8pm friday 26 july']
+
+
+def utc(*args):
+    return datetime.datetime(*args, tzinfo=datetime.timezone.utc)
+
+
+# Around DST transitions in both hemispheres, month and year ends and a leap day that is not there.
+bases = [utc(2026, 3, 8, 5), utc(2026, 3, 28, 23), utc(2026, 4, 4, 14), utc(2026, 9, 26, 13), utc(2026, 10, 24, 23),
+         utc(2026, 11, 1, 4), utc(2026, 2, 28, 20), utc(2026, 6, 30, 17), utc(2026, 12, 31, 20),
+         utc(2026, 7, 15, 11, 59)]
+
+
+def arguments():
+    args = {"{0} {1}".format(day, time).strip() for day in days for time in times}
+    args |= {"{0} {1}".format(time, day).strip() for day in days for time in times}
+    args.discard('')
+    return sorted(args) + others
+
+
+def cases(tz_name):
+    """ every argument once, each against a base up to two hours from an edge """
+    rng = random.Random(tz_name)
+    for argument in arguments():
+        base = rng.choice(bases) + datetime.timedelta(seconds=rng.randint(-7200, 7200),
+                                                      microseconds=rng.randint(1, 999999))
+        yield base, argument
+
+
+@pytest.mark.parametrize('tz_name', zones)
+def test_fast_path_matches_dateparser(tz_name, monkeypatch):
+    """ wherever the fast path answers, dateparser alone must give the same timestamp """
+    fast_parse = time_parser.fast_parse
+    tz = pytz.timezone(tz_name)
+    fast = 0
+    for base, argument in cases(tz_name):
+        if fast_parse(argument, base.astimezone(tz).replace(tzinfo=None), tz) is None:
+            continue
+        fast += 1
+        expected = time_parser.parse(argument, tz_name, False, base)
+        monkeypatch.setattr(time_parser, 'fast_parse', lambda *args: None)
+        actual = time_parser.parse(argument, tz_name, False, base)
+        monkeypatch.setattr(time_parser, 'fast_parse', fast_parse)
+        assert (expected and expected.timestamp()) == (actual and actual.timestamp()), (argument, base)
+    # Most of the corpus is meant for the fast path.
+    assert fast > len(arguments()) // 2
+
+
+@pytest.mark.parametrize('argument', others)
+def test_fast_path_declines(argument):
+    tz = pytz.timezone('Europe/Berlin')
+    assert time_parser.fast_parse(argument, datetime.datetime(2026, 7, 15, 12), tz) is None
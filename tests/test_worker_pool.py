@@ -0,0 +1,57 @@
+import asyncio
+import os
+import threading
+from concurrent.futures import BrokenExecutor, ThreadPoolExecutor
+
+from utils import WorkerPool
+
+
+class BrokenThreadPool(ThreadPoolExecutor):
+    def submit(self, fn, *args, **kwargs):
+        raise BrokenExecutor("broken for the test")
+
+
+def where():
+    return os.getpid(), threading.get_ident()
+
+
+async def run_where(pool):
+    return await pool.run('where', where), where()
+
+
+def test_runs_after_process_pool_broke():
+    pool = WorkerPool('process', 2)
+    try:
+        async def main():
+            await pool.run('pid', os.getpid)
+            broken = pool.executor
+            for process in list(broken._processes.values()):
+                process.kill()
+            pids = await asyncio.gather(*(pool.run('pid', os.getpid) for n in range(4)))
+            return broken, pids
+
+        broken, pids = asyncio.run(main())
+        assert pool.executor is not broken
+        # Still computed by worker processes rather than on the event loop.
+        assert os.getpid() not in pids
+        assert pool.histograms['pid'].count == 5
+    finally:
+        # Leave no live workers behind for the interpreter to wait on at exit.
+        pool.executor.shutdown(wait=True)
+
+
+def test_never_runs_on_the_event_loop(monkeypatch):
+    pool = WorkerPool('thread', 1)
+
+    def start(initializer=None, initargs=()):
+        # Every pool it starts is broken, so the call ends up on the default executor.
+        if not isinstance(pool.executor, BrokenThreadPool):
+            pool.executor = BrokenThreadPool(1)
+
+    monkeypatch.setattr(pool, 'start', start)
+    try:
+        (pid, worker_thread), (loop_pid, loop_thread) = asyncio.run(run_where(pool))
+        assert pid == loop_pid
+        assert worker_thread != loop_thread
+    finally:
+        pool.shutdown()